@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import ast
 import sys 
 
@@ -40,33 +41,156 @@ def load_reference_database(reference_database_path):
 
     return reference_entries
 
-def find_kmd_matches_actual(mass_list, reference_entries):
-    """Find KMD matches for a given list of masses against the reference entries."""
-    results = {}
-
-    for entry in mass_list:
-        mass_part = entry.split('(')[-1].strip(')')
-        mass = sanitize_mass_string(mass_part)
-
-        if mass is None:
-            continue
-
-        km = calculate_kendrick_mass(mass)
-        kmd = kendrick_mass_defect(km)
-
-        matches = []
+class KMDReferenceTable:
+    """The reference entries as arrays: KMDs in a numpy array, abbreviations and sub classes in reference order."""
+    def __init__(self, reference_entries):
+        self.kmd = np.array([ref_entry.kmd for ref_entry in reference_entries], dtype=np.float64)
+        self.general_abbreviation = [ref_entry.general_abbreviation for ref_entry in reference_entries]
+        self.sub_class = [ref_entry.sub_class for ref_entry in reference_entries]
+
+    def __len__(self):
+        return len(self.kmd)
+
+    def __repr__(self):
+        return f"KMDReferenceTable(entries={len(self)})"
+
+
+KMD_MATCH_DTYPE = np.dtype([('query', np.int64), ('reference', np.int64), ('n', np.int64)])
+
+
+class KMDReferenceIndex(KMDReferenceTable):
+    """
+    KMDReferenceTable with the reference KMDs sorted. A match needs kmd - reference kmd = n * 0.0134 (+/- 0.0075 * 0.0134)
+    for an integer n from -15 to 0, so each mass only looks at 16 narrow KMD windows, found with np.searchsorted,
+    and the candidates get the same exact test as kmd_match_arrays. Build it once and reuse it for every sample.
+    """
+    def __init__(self, reference_entries):
+        super().__init__(reference_entries)
+        self.order = np.argsort(self.kmd, kind='stable')
+        self.sorted_kmd = self.kmd[self.order]
+
+    @classmethod
+    def from_csv(cls, reference_database_path):
+        return cls(load_reference_database(reference_database_path))
+
+    def __repr__(self):
+        return f"KMDReferenceIndex(entries={len(self)})"
+
+    def match_arrays(self, masses, tolerance=0.0075):
+        """Same structured matches as kmd_match_arrays (ordered by query then reference)."""
+        masses = np.asarray(masses, dtype=np.float64)
+        km = calculate_kendrick_mass(masses)
+        kmd = km - np.trunc(km)
+
+        pad = 1e-9 # the windows are only a preselection, the exact test is below
+        queries, candidates = [], []
+        for n in range(-15, 1):
+            start = np.searchsorted(self.sorted_kmd, kmd - 0.0134 * (n + tolerance) - pad, side='left')
+            end = np.searchsorted(self.sorted_kmd, kmd - 0.0134 * (n - tolerance) + pad, side='right')
+            window_sizes = np.where(np.isnan(kmd), 0, np.maximum(end - start, 0))
+            queries.append(np.repeat(np.arange(len(masses)), window_sizes))
+            candidates.append(np.arange(window_sizes.sum()) + np.repeat(start - (np.cumsum(window_sizes) - window_sizes), window_sizes))
+        query = np.concatenate(queries)
+        reference_position = self.order[np.concatenate(candidates)]
+
+        result = (kmd[query] - self.kmd[reference_position]) / 0.0134
+        closest_integer = np.round(result)
+        is_match = (-16 < closest_integer) & (closest_integer < 0.5) & (np.abs(result - closest_integer) <= tolerance)
+
+        matches = np.empty(int(is_match.sum()), dtype=KMD_MATCH_DTYPE)
+        matches['query'] = query[is_match]
+        matches['reference'] = reference_position[is_match]
+        matches['n'] = np.abs(closest_integer[is_match]).astype(np.int64)
+        return matches[np.lexsort((matches['reference'], matches['query']))]
+
+
+_kmd_reference_indexes = {} # built once per process and kept for the next samples
+
+
+def load_kmd_reference_index(reference_database_path):
+    if reference_database_path not in _kmd_reference_indexes:
+        _kmd_reference_indexes[reference_database_path] = KMDReferenceIndex.from_csv(reference_database_path)
+    return _kmd_reference_indexes[reference_database_path]
+
+
+def masses_from_formula_list(mass_list):
+    """Mass of every 'formula (mass)' entry and whether it could be read (entries that can not be read are skipped)."""
+    masses = np.full(len(mass_list), np.nan)
+    readable = np.zeros(len(mass_list), dtype=bool)
+    for i, entry in enumerate(mass_list):
+        mass = sanitize_mass_string(entry.split('(')[-1].strip(')'))
+        if mass is not None:
+            masses[i] = mass
+            readable[i] = True
+    return masses, readable
+
+
+def kmd_match_arrays(masses, reference, chunk_size=2048, tolerance=0.0075):
+    """
+    All (mass, reference) KMD matches in broadcast blocks of chunk_size masses, same rules as before:
+    n = round((kmd - reference kmd) / 0.0134) with -16 < n < 0.5 and |result - n| <= tolerance (0.0075).
+
+    Returns a structured array (KMD_MATCH_DTYPE) of 'query' (position in masses), 'reference' (position in the
+    reference table) and 'n' (abs(n), the number of CH2 groups), ordered by query then reference.
+    """
+    if not isinstance(reference, KMDReferenceTable):
+        reference = KMDReferenceTable(reference)
+    if isinstance(reference, KMDReferenceIndex):
+        return reference.match_arrays(masses, tolerance)
+    masses = np.asarray(masses, dtype=np.float64)
+
+    km = calculate_kendrick_mass(masses)
+    kmd = km - np.trunc(km) # as kendrick_mass_defect, int() truncates
+
+    matches = []
+    for start in range(0, len(masses), chunk_size):
+        result = (kmd[start:start + chunk_size, None] - reference.kmd[None, :]) / 0.0134
+        closest_integer = np.round(result) # half to even as Python round
+        is_match = (-16 < closest_integer) & (closest_integer < 0.5) & (np.abs(result - closest_integer) <= tolerance) # NaN masses never match
+        query, reference_position = np.nonzero(is_match)
+        block = np.empty(len(query), dtype=KMD_MATCH_DTYPE)
+        block['query'] = query + start
+        block['reference'] = reference_position
+        block['n'] = np.abs(closest_integer[query, reference_position]).astype(np.int64)
+        matches.append(block)
+    return np.concatenate(matches) if matches else np.empty(0, dtype=KMD_MATCH_DTYPE)
+
+
+def find_kmd_matches_grouped(entries, masses, group_index, n_groups, reference_entries, tolerance=0.0075):
+    """
+    KMD matches of a flat table of formula candidates: entries (the keys, e.g. 'formula (mass)'), their masses and
+    the group (EIC) of every candidate. Returns one {entry: [(general abbreviation, n, sub class), ...]} per group,
+    keys in the order of the table.
+    """
+    reference = reference_entries if isinstance(reference_entries, KMDReferenceTable) else KMDReferenceTable(reference_entries)
+
+    matches = kmd_match_arrays(masses, reference, tolerance=tolerance)
+    match_starts = np.searchsorted(matches['query'], np.arange(len(entries) + 1)).tolist()
+    reference_positions = matches['reference'].tolist()
+    ns = matches['n'].tolist()
+
+    results = [{} for _ in range(n_groups)]
+    for query, (entry, group) in enumerate(zip(entries, np.asarray(group_index).tolist())):
+        start, end = match_starts[query], match_starts[query + 1]
+        results[group][entry] = [(reference.general_abbreviation[r], n, reference.sub_class[r]) for r, n in zip(reference_positions[start:end], ns[start:end])]
+    return results
 
-        for ref_entry in reference_entries:
-            difference = kmd - ref_entry.kmd
-            result = difference / 0.0134
-            closest_integer = round(result)
 
-            if -16 < closest_integer < 0.5 and abs(result - closest_integer) <= 0.0075:
-                matches.append((ref_entry.general_abbreviation, abs(closest_integer), ref_entry.sub_class))
+def find_kmd_matches_batch(formula_lists, reference_entries):
+    """
+    KMD matches of many formula lists (e.g. all EICs of a run) against the reference in one go.
+    Returns one {formula entry: [(general abbreviation, n, sub class), ...]} per formula list, as find_kmd_matches_actual.
+    """
+    entries = [entry for mass_list in formula_lists for entry in mass_list]
+    group_index = np.repeat(np.arange(len(formula_lists)), [len(mass_list) for mass_list in formula_lists])
+    masses, readable = masses_from_formula_list(entries)
+    return find_kmd_matches_grouped([entry for entry, keep in zip(entries, readable) if keep], masses[readable], group_index[readable], 
+                                    len(formula_lists), reference_entries)
 
-        results[entry] = matches
 
-    return results
+def find_kmd_matches_actual(mass_list, reference_entries):
+    """Find KMD matches for a given list of masses against the reference entries."""
+    return find_kmd_matches_batch([mass_list], reference_entries)[0]
 
 def find_kmd_matches(row, index, reference_entries):
     """Convert the string representation of a list to an actual list and find KMD matches."""
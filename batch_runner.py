@@ -0,0 +1,149 @@
+import argparse
+import glob
+import multiprocessing
+from multiprocessing.util import Finalize
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import runner
+from centwave import new_eic_executor
+from mass_decomposer import DecompositionCache
+from pipeline import LipsIpPipeline, load_shared_state
+
+# Runs the pipeline (pipeline.py, with the parameters of runner.py as defaults) on many raw files:
+#   python batch_runner.py 'study_folder/*.mzXML' other_file.mzML --output-folder batch_outputs --sample-workers 4
+# The models and databases are loaded once in the main process, every sample then runs in a worker process
+# (a failing sample is reported in the summary and does not stop the others).
+# Outputs: {output folder}/{sample}/ with the trackable outputs and {sample}_output.csv, and {output folder}/batch_summary.csv
+
+# state of a sample worker process
+_shared_state = None
+_decomposition_cache = None
+_r_eic_executor = None
+
+
+def _init_sample_worker(shared_state, decomposition_cache_path, eic_detector):
+    global _shared_state, _decomposition_cache, _r_eic_executor
+    _shared_state = shared_state # inherited from the main process with fork
+    _decomposition_cache = DecompositionCache(shared_state['decomposer'], decomposition_cache_path) # own sqlite connection per worker
+    if eic_detector == 'R':
+        _r_eic_executor = new_eic_executor() # R and xcms are loaded once per worker and kept for its next samples
+    # closed when the worker process exits (atexit handlers do not run in pool workers, multiprocessing finalizers do)
+    Finalize(None, _close_sample_worker, exitpriority=10)
+
+
+def _close_sample_worker():
+    global _decomposition_cache, _r_eic_executor
+    if _r_eic_executor is not None:
+        _r_eic_executor.shutdown()
+        _r_eic_executor = None
+    if _decomposition_cache is not None:
+        _decomposition_cache.close()
+        _decomposition_cache = None
+
+
+def _run_sample_in_worker(raw_file_path, output_root, run_kwargs):
+    sample_name = os.path.basename(raw_file_path)
+    output_folder = os.path.join(output_root, sample_name)
+    try:
+        pipeline = LipsIpPipeline(_shared_state, output_folder=output_folder, decomposition_cache=_decomposition_cache, 
+                                  r_eic_executor=_r_eic_executor, **run_kwargs)
+        final_df, summary = pipeline.run(raw_file_path, final_output_path=os.path.join(output_folder, f'{sample_name}_output.csv'))
+        summary['status'] = 'ok'
+    except Exception:
+        summary = {'sample': sample_name, 'status': 'failed', 'error': traceback.format_exc()}
+    return summary
+
+
+def expand_raw_files(patterns):
+    '''Raw files of the given paths and glob patterns, each file once, in the given order.'''
+    raw_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        raw_files.extend(path for path in matches if path.lower().endswith(('.mzxml', '.mzml')))
+    return list(dict.fromkeys(raw_files))
+
+
+def run_batch(raw_files, output_root='batch_outputs', sample_workers=1, workers_per_sample=None, decomposition_cache_path=runner.decomposition_cache_path,
+              rr_grid_folder=runner.rr_grid_folder, **run_kwargs):
+    '''
+    Runs LipsIpPipeline for every raw file, sample_workers samples at the same time.
+    run_kwargs are passed on to LipsIpPipeline (pred_interval, charge, mass_error, eic_detector, rr_grid_method, ...),
+    rr_grid_folder too, its grids are loaded once here for all samples.
+
+    Return
+    ======
+        DataFrame with the summary of every sample (also saved as batch_summary.csv in output_root)
+    '''
+    if workers_per_sample is None:
+        workers_per_sample = max(1, os.cpu_count() // sample_workers)
+    run_kwargs = dict(run_kwargs, n_workers=workers_per_sample, rr_grid_folder=rr_grid_folder)
+    eic_detector = run_kwargs.get('eic_detector', runner.eic_detector)
+    os.makedirs(output_root, exist_ok=True)
+
+    start_time = time.time()
+    print('Loading models and databases...')
+    shared_state = load_shared_state(pred_interval=run_kwargs.get('pred_interval', runner.pred_interval), rr_grid_folder=rr_grid_folder,
+                                     rr_backend=run_kwargs.get('rr_backend', runner.rr_backend))
+
+    if 'fork' in multiprocessing.get_all_start_methods(): # fork shares the loaded state instead of pickling it to every worker
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = multiprocessing.get_context()
+
+    print(f'Processing {len(raw_files)} samples, {sample_workers} at a time...')
+    summaries = []
+    with ProcessPoolExecutor(max_workers=sample_workers, mp_context=mp_context, initializer=_init_sample_worker,
+                             initargs=(shared_state, decomposition_cache_path, eic_detector)) as executor:
+        futures = [executor.submit(_run_sample_in_worker, raw_file_path, output_root, run_kwargs) for raw_file_path in raw_files]
+        for raw_file_path, future in zip(raw_files, futures):
+            try:
+                summary = future.result()
+            except Exception: # the worker process itself died
+                summary = {'sample': os.path.basename(raw_file_path), 'status': 'failed', 'error': traceback.format_exc()}
+            summary['raw_file'] = raw_file_path
+            print(summary['sample'], summary['status'])
+            summaries.append(summary)
+
+    summary_df = pd.DataFrame(summaries)
+    summary_df.to_csv(os.path.join(output_root, 'batch_summary.csv'), index=False)
+    print(f"{(summary_df['status'] == 'ok').sum()} of {len(raw_files)} samples done in", time.time() - start_time, 'seconds')
+    return summary_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the LIPS-IP pipeline on many mzXML/mzML files')
+    parser.add_argument('raw_files', nargs='+', help='raw files or glob patterns (quote them)')
+    parser.add_argument('--output-folder', default='batch_outputs')
+    parser.add_argument('--sample-workers', type=int, default=1, help='samples processed at the same time')
+    parser.add_argument('--workers-per-sample', type=int, default=None, help='processes per sample for triple mining and mass decomposition')
+    parser.add_argument('--eic-detector', choices=['R', 'native'], default=runner.eic_detector)
+    parser.add_argument('--centwave-ppm', type=float, default=runner.centwave_ppm, help='ROI m/z tolerance of centWave')
+    parser.add_argument('--streaming', action='store_true', default=runner.streaming)
+    parser.add_argument('--charge', type=int, default=runner.charge)
+    parser.add_argument('--mass-error', type=float, default=runner.mass_error, help='ppm')
+    parser.add_argument('--pred-interval', type=float, default=runner.pred_interval)
+    parser.add_argument('--rr-backend', choices=['R', 'numpy'], default=runner.rr_backend, help="'numpy' only once export_rr_models.py has checked the models against R")
+    parser.add_argument('--rr-grid-folder', default=runner.rr_grid_folder, help='precomputed RR grids (built on first use), exact predictions if not given')
+    parser.add_argument('--rr-grid-method', choices=['nearest', 'linear'], default=runner.rr_grid_method)
+    parser.add_argument('--validate-rr-grids', action='store_true', default=runner.validate_rr_grids_against_exact,
+                        help='also predict exactly and save how much the grid lookup differs')
+    parser.add_argument('--nitrogen-rule', action='store_true', default=runner.nitrogen_rule)
+    parser.add_argument('--kmd-tolerance', type=float, default=runner.kmd_tolerance)
+    parser.add_argument('--decomposition-cache', default=runner.decomposition_cache_path)
+    parser.add_argument('--checkpoint-folder', default=runner.checkpoint_folder, help='shared by all samples, checkpoints are keyed by raw file hash')
+    args = parser.parse_args()
+
+    raw_files = expand_raw_files(args.raw_files)
+    if not raw_files:
+        parser.error('no .mzXML or .mzML files found')
+
+    run_batch(raw_files, output_root=args.output_folder, sample_workers=args.sample_workers, workers_per_sample=args.workers_per_sample,
+              decomposition_cache_path=args.decomposition_cache, rr_backend=args.rr_backend, rr_grid_folder=args.rr_grid_folder, rr_grid_method=args.rr_grid_method,
+              validate_rr_grids_against_exact=args.validate_rr_grids, eic_detector=args.eic_detector, centwave_ppm=args.centwave_ppm,
+              streaming=args.streaming, charge=args.charge, mass_error=args.mass_error, pred_interval=args.pred_interval, nitrogen_rule=args.nitrogen_rule,
+              kmd_tolerance=args.kmd_tolerance, checkpoint_folder=args.checkpoint_folder)
@@ -1,19 +1,25 @@
-import rpy2.robjects as robjects
-from rpy2.robjects.packages import importr
 import pandas as pd
+import numpy as np
 import gc 
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from peak_picking import ScanPeakArrays, EICTable, generate_scan_arrays_for_all_rt
 
 # centWave from R
-def centwave_on_raw_data(file_path, output_file):
+def centwave_on_raw_data(file_path, output_file, ppm=5):
+    import rpy2.robjects as robjects # R is only started for the R centWave
+    from rpy2.robjects.packages import importr
+
     xcms = importr('xcms')
     MSnbase = importr('MSnbase')
 
     r_script = """
-    process_mass_spec_file <- function(file_path) {
+    process_mass_spec_file <- function(file_path, ppm) {
       ms_data <- readMSData(file_path, mode = "onDisk")
       
-      cwp <- CentWaveParam(ppm = 5, peakwidth = c(6, 60), snthresh = 1,
+      cwp <- CentWaveParam(ppm = ppm, peakwidth = c(6, 60), snthresh = 1,
                            prefilter = c(3, 5000), mzCenterFun = "wMean", integrate = 1, 
                            mzdiff = -0.001, fitgauss = FALSE, noise = 0,
                            verboseColumns = FALSE, firstBaselineCheck = TRUE)
@@ -27,7 +33,7 @@ def centwave_on_raw_data(file_path, output_file):
     """
     robjects.r(r_script)
     process_mass_spec_file = robjects.globalenv['process_mass_spec_file']
-    process_mass_spec_file(file_path)
+    process_mass_spec_file(file_path, ppm)
 
     robjects.r('''
       peaks <- chromPeaks(result)
@@ -49,3 +55,242 @@ def centwave_on_raw_data(file_path, output_file):
         robjects.r('gc()')
         gc.collect()
 
+
+# Native centWave (same parameters as above), on the scans already loaded for the triple mining
+
+def find_rois(scan_arrays, ppm=5, prefilter=(3, 5000), min_scans=1):
+    '''
+    Regions of interest as in xcms findmzROI: going through the scans in RT order, every centroid extends the
+    open ROI whose mean m/z is within ppm (at most one centroid per ROI and scan, the closest) or starts a new one.
+    A ROI is closed in the first scan that does not extend it.
+
+    Return
+    ======
+        list of ROIs as arrays of positions in the flat scan_arrays.mz / intensity, one per scan, kept if they
+        have at least min_scans scans and prefilter[0] centroids with intensity >= prefilter[1]
+    '''
+    n_scans = len(scan_arrays)
+    point_roi = [] # per scan: ROI of every centroid
+    point_position = []
+
+    open_ids = np.empty(0, dtype=np.int64)
+    open_mz_sum = np.empty(0)
+    open_n = np.empty(0, dtype=np.int64)
+    next_id = 0
+
+    for i in range(n_scans):
+        start, end = scan_arrays.offsets[i], scan_arrays.offsets[i + 1]
+        positions = np.arange(start, end)
+        mz = scan_arrays.mz[start:end]
+
+        roi_index = np.full(len(mz), -1, dtype=np.int64) # position in the open arrays
+        if len(open_ids) and len(mz):
+            open_mz = open_mz_sum / open_n
+            order = np.argsort(open_mz, kind='stable')
+            sorted_mz = open_mz[order]
+            right = np.clip(np.searchsorted(sorted_mz, mz), 1, len(sorted_mz) - 1) if len(sorted_mz) > 1 else np.zeros(len(mz), dtype=np.int64)
+            left = np.maximum(right - 1, 0)
+            nearest = np.where(np.abs(sorted_mz[left] - mz) <= np.abs(sorted_mz[right] - mz), left, right)
+            distance = np.abs(sorted_mz[nearest] - mz)
+            matched = distance <= sorted_mz[nearest] * ppm * 1e-6
+
+            # only the closest centroid of a scan extends a ROI
+            candidates = np.flatnonzero(matched)
+            candidates = candidates[np.lexsort((distance[candidates], nearest[candidates]))]
+            first = np.ones(len(candidates), dtype=bool)
+            first[1:] = nearest[candidates][1:] != nearest[candidates][:-1]
+            roi_index[candidates[first]] = order[nearest[candidates[first]]]
+
+        extended = np.zeros(len(open_ids), dtype=bool)
+        extended[roi_index[roi_index >= 0]] = True
+        np.add.at(open_mz_sum, roi_index[roi_index >= 0], mz[roi_index >= 0])
+        np.add.at(open_n, roi_index[roi_index >= 0], 1)
+
+        new = roi_index < 0
+        new_ids = np.arange(next_id, next_id + new.sum())
+        next_id += len(new_ids)
+        ids = np.empty(len(mz), dtype=np.int64)
+        ids[~new] = open_ids[roi_index[~new]]
+        ids[new] = new_ids
+        point_roi.append(ids)
+        point_position.append(positions)
+
+        # ROIs not extended in this scan are closed
+        open_ids = np.concatenate([open_ids[extended], new_ids])
+        open_mz_sum = np.concatenate([open_mz_sum[extended], mz[new]])
+        open_n = np.concatenate([open_n[extended], np.ones(len(new_ids), dtype=np.int64)])
+
+    if not point_roi:
+        return []
+    point_roi = np.concatenate(point_roi)
+    point_position = np.concatenate(point_position)
+
+    order = np.argsort(point_roi, kind='stable') # positions stay in scan order within a ROI
+    point_roi, point_position = point_roi[order], point_position[order]
+    roi_starts = np.flatnonzero(np.r_[True, point_roi[1:] != point_roi[:-1], True])
+
+    above_prefilter = np.add.reduceat((scan_arrays.intensity[point_position] >= prefilter[1]).astype(np.int64), roi_starts[:-1]) if len(point_roi) else np.empty(0)
+    lengths = np.diff(roi_starts)
+    return [point_position[s:e] for s, e, n_above, length in zip(roi_starts[:-1], roi_starts[1:], above_prefilter, lengths)
+            if n_above >= prefilter[0] and length >= min_scans]
+
+
+def _ricker(width):
+    x = np.arange(-5 * width, 5 * width + 1)
+    return 2 / (np.sqrt(3 * width) * np.pi**0.25) * (1 - (x / width)**2) * np.exp(-(x / width)**2 / 2)
+
+
+def _descend_min(values, apex):
+    # as xcms descendMin: walk down from the apex on both sides while the values decrease
+    left = apex
+    while left > 0 and values[left - 1] < values[left]:
+        left -= 1
+    right = apex
+    while right < len(values) - 1 and values[right + 1] < values[right]:
+        right += 1
+    return left, right
+
+
+def centwave_native(scan_arrays, ppm=5, peakwidth=(6, 60), snthresh=1, prefilter=(3, 5000), integrate=1, noise=0, first_baseline_check=True):
+    '''
+    centWave peak detection in Python on the loaded scans (ScanPeakArrays or an MSExperiment), with the same
+    parameters as centwave_on_raw_data, so the raw file is not read again by R.
+
+    ROIs from find_rois, then per ROI a continuous wavelet transform (Mexican hat) over the scales of peakwidth.
+    Peaks are the maxima of the wavelet coefficients over the scales. With integrate=1 the peak limits come from
+    descending the filtered trace at the best scale, otherwise apex +/- best scale. The m/z centre is the
+    intensity weighted mean (wMean) of the centroids in the peak. This follows xcms, it is not a line by line port,
+    so the EICs are close to but not exactly the R ones.
+
+    Return
+    ======
+        DataFrame like chromPeaks(): mz, mzmin, mzmax, rt, rtmin, rtmax, into, maxo, sn
+    '''
+    if not isinstance(scan_arrays, ScanPeakArrays):
+        scan_arrays = generate_scan_arrays_for_all_rt(scan_arrays)
+
+    columns = ['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'into', 'maxo', 'sn']
+    if len(scan_arrays) < 2:
+        return pd.DataFrame(columns=columns)
+
+    scan_time = float(np.median(np.diff(scan_arrays.rts)))
+    min_scale = max(1, int(np.floor(peakwidth[0] / scan_time / 2)))
+    max_scale = max(min_scale, int(np.ceil(peakwidth[1] / scan_time / 2)))
+    scales = np.arange(min_scale, max_scale + 1, 2)
+    wavelets = [_ricker(scale) for scale in scales]
+
+    point_scan = np.repeat(np.arange(len(scan_arrays)), np.diff(scan_arrays.offsets))
+    rois = find_rois(scan_arrays, ppm=ppm, prefilter=prefilter, min_scans=min_scale)
+
+    peaks = []
+    for roi in rois:
+        scans = point_scan[roi]
+        mz = scan_arrays.mz[roi]
+        intensity = scan_arrays.intensity[roi].astype(np.float64)
+
+        # baseline and noise from the lower part of the ROI trace
+        sorted_intensity = np.sort(intensity)
+        lower_part = sorted_intensity[:max(1, int(np.ceil(len(sorted_intensity) / 2)))]
+        baseline = max(float(np.mean(lower_part)), noise)
+        sd_noise = max(float(np.std(lower_part)), 1.0)
+        if first_baseline_check and not np.any(intensity > baseline):
+            continue
+
+        coefs = np.array([np.convolve(intensity, wavelet)[len(wavelet) // 2:len(wavelet) // 2 + len(intensity)] for wavelet in wavelets])
+        best_scale = np.argmax(coefs, axis=0)
+        envelope = coefs[best_scale, np.arange(len(intensity))]
+
+        is_max = envelope > 0
+        is_max[1:] &= envelope[1:] >= envelope[:-1]
+        is_max[:-1] &= envelope[:-1] > envelope[1:]
+
+        taken = np.zeros(len(intensity), dtype=bool)
+        for apex in np.flatnonzero(is_max)[np.argsort(-envelope[is_max], kind='stable')]: # strongest first
+            if taken[apex]:
+                continue
+            scale = scales[best_scale[apex]]
+            if integrate == 1:
+                left, right = _descend_min(coefs[best_scale[apex]], apex)
+            else:
+                left, right = max(0, apex - scale), min(len(intensity) - 1, apex + scale)
+            left, right = min(left, apex), max(right, apex)
+            # a peak stops where a stronger peak of the same ROI starts
+            taken_left = np.flatnonzero(taken[left:apex])
+            if len(taken_left):
+                left += taken_left[-1] + 1
+            taken_right = np.flatnonzero(taken[apex + 1:right + 1])
+            if len(taken_right):
+                right = apex + taken_right[0]
+
+            peak_intensity = intensity[left:right + 1]
+            maxo = float(peak_intensity.max())
+            sn = (maxo - baseline) / sd_noise
+            if sn < snthresh:
+                continue
+            taken[left:right + 1] = True
+
+            peak_mz = mz[left:right + 1]
+            peak_rts = scan_arrays.rts[scans[left:right + 1]]
+            rt_range = peak_rts[-1] - peak_rts[0]
+            peaks.append((float(np.sum(peak_mz * peak_intensity) / np.sum(peak_intensity)), float(peak_mz.min()), float(peak_mz.max()),
+                          float(peak_rts[np.argmax(peak_intensity)]), float(peak_rts[0]), float(peak_rts[-1]),
+                          float(np.sum(peak_intensity) * (rt_range / (len(peak_intensity) - 1) if len(peak_intensity) > 1 else scan_time)),
+                          maxo, float(sn)))
+
+    peaks_df = pd.DataFrame(peaks, columns=columns)
+    return peaks_df.sort_values(by=['mz', 'rt']).reset_index(drop=True)
+
+
+def detect_eics(eic_detector, raw_file_path, output_file, scan_arrays=None, ppm=5):
+    '''
+    EICTable from the R centWave ('R', reads raw_file_path) or centwave_native ('native', on scan_arrays).
+    The peaks are written to output_file in both cases, ppm is the centWave ROI tolerance of both.
+    '''
+    if eic_detector == 'native':
+        centwave_df = centwave_native(scan_arrays, ppm=ppm)
+        centwave_df.to_csv(output_file, index=False) # kept as trackable output, not read back
+        return EICTable.from_dataframe(centwave_df)
+    centwave_on_raw_data(raw_file_path, output_file, ppm=ppm)
+    return EICTable.from_centwave_csv(output_file)
+
+
+# scan arrays of the EIC process, set by the pool initializer
+_worker_scan_arrays = None
+
+
+def _init_eic_worker(scan_arrays):
+    global _worker_scan_arrays
+    _worker_scan_arrays = scan_arrays
+
+
+def _detect_eics_in_worker(eic_detector, raw_file_path, output_file, ppm):
+    return detect_eics(eic_detector, raw_file_path, output_file, _worker_scan_arrays, ppm)
+
+
+def start_eic_detection(eic_detector, raw_file_path, output_file, scan_arrays=None, ppm=5, executor=None):
+    '''
+    Starts detect_eics in its own process, so it runs while the triples are mined.
+    executor: optional executor kept by the caller over many files (e.g. R and xcms stay loaded in it for the R centWave),
+    by default a new single process executor is started. The scan arrays of the native centWave are handed to a new
+    process when it starts (new_eic_executor), not with the call, so a given executor is not used for them.
+
+    Return
+    ======
+        (executor, future), future.result() is the EICTable (the join point), shut the executor down after if it was started here
+    '''
+    if scan_arrays is not None or executor is None:
+        executor = new_eic_executor(scan_arrays)
+    future = executor.submit(_detect_eics_in_worker, eic_detector, raw_file_path, output_file, ppm)
+    return executor, future
+
+
+def new_eic_executor(scan_arrays=None):
+    '''
+    Single process executor for detect_eics. scan_arrays go to the process through the pool initializer: with fork
+    the process inherits them copy-on-write, only other start methods pickle them (once, when the process starts).
+    '''
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = multiprocessing.get_context()
+    return ProcessPoolExecutor(max_workers=1, mp_context=mp_context, initializer=_init_eic_worker, initargs=(scan_arrays,))
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import pickle
+
+CHECKPOINT_VERSION = 3 # raise when a stage changes its results, older checkpoints are then not used anymore
+
+_file_hashes = {} # (path, size, mtime) -> sha1, a file is only hashed again when it changes
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''sha1 of the content of a file, read in chunks (raw files can be several GB).'''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        _file_hashes[key] = sha1.hexdigest()
+    return _file_hashes[key]
+
+
+def stage_key(input_key, stage, params):
+    '''
+    Content address of a stage output: the key of its input (the previous stage, or the raw file hash for the first one)
+    together with the stage name and its own parameters, so a changed parameter also changes the keys of all later stages.
+    '''
+    payload = json.dumps({'version': CHECKPOINT_VERSION, 'input': input_key, 'stage': stage, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class CheckpointStore:
+    '''
+    Stage outputs pickled as {folder}/{stage}_{key}.pkl. A checkpoint is written to a temporary file first and then
+    renamed, so a run that crashes while saving never leaves a broken checkpoint behind.
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def __repr__(self):
+        return f"CheckpointStore({self.folder!r})"
+
+    def path(self, stage, key):
+        return os.path.join(self.folder, f'{stage}_{key}.pkl')
+
+    def exists(self, stage, key):
+        return os.path.exists(self.path(stage, key))
+
+    def load(self, stage, key):
+        with open(self.path(stage, key), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, stage, key, outputs):
+        path = self.path(stage, key)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(outputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
@@ -1,38 +1,518 @@
+import itertools
+import json
+import os
+import re
+from statistics import NormalDist
 import numpy as np
 import pandas as pd
-from rpy2.robjects import pandas2ri, r
-from rpy2.robjects.packages import importr
-import rpy2.robjects as ro
 
-base = importr('base')
-utils = importr('utils')
-flexmix = importr('flexmix')
+from checkpoints import file_hash
+
+class RRLookupIndex:
+    '''
+    The RR lookup table sorted by RR, with a sparse table of the min and max of every element column
+    (level j holds the min/max of 2**j consecutive rows). The rows with lower <= RR <= upper are found with
+    two np.searchsorted calls and their element min/max from two overlapping power of two blocks, so each
+    query is O(log rows) instead of filtering the whole table. NaNs in the element columns are skipped as pandas does.
+    '''
+    def __init__(self, lipid_and_swiss_df, elements=('C', 'H', 'N', 'O', 'P'), rr_column='RR21'):
+        rr = lipid_and_swiss_df[rr_column].to_numpy(dtype=np.float64)
+        keep = ~np.isnan(rr) # rows without RR never fall in a range
+        order = np.argsort(rr[keep], kind='stable')
+        self.rr_column = rr_column
+        self.rr = rr[keep][order]
+        self.min_tables = {}
+        self.max_tables = {}
+        for element in elements:
+            values = lipid_and_swiss_df[element].to_numpy(dtype=np.float64)[keep][order]
+            self.min_tables[element] = self._sparse_table(values, np.fmin)
+            self.max_tables[element] = self._sparse_table(values, np.fmax)
+
+    @staticmethod
+    def _sparse_table(values, combine):
+        levels = [values]
+        width = 1
+        while 2 * width <= len(values):
+            previous = levels[-1]
+            levels.append(combine(previous[:len(previous) - width], previous[width:]))
+            width *= 2
+        return levels
+
+    def __repr__(self):
+        return f"RRLookupIndex({self.rr_column}, {len(self.rr)} rows, elements={list(self.min_tables)})"
+
+    def element_range(self, element, lower_limits, upper_limits):
+        '''Min and max of element over the rows with lower <= RR <= upper for every (lower, upper), NaN if there are none.'''
+        lower_limits = np.asarray(lower_limits, dtype=np.float64)
+        upper_limits = np.asarray(upper_limits, dtype=np.float64)
+        start = np.searchsorted(self.rr, lower_limits, side='left')
+        end = np.searchsorted(self.rr, upper_limits, side='right')
+        found = (end > start) & ~np.isnan(lower_limits) & ~np.isnan(upper_limits)
+
+        element_min = np.full(len(lower_limits), np.nan)
+        element_max = np.full(len(lower_limits), np.nan)
+        start, end = start[found], end[found]
+        level = np.floor(np.log2(end - start)).astype(np.int64)
+        second_start = end - (1 << level)
+        mins = np.full(len(start), np.nan)
+        maxs = np.full(len(start), np.nan)
+        for j in np.unique(level):
+            at_level = level == j
+            min_table, max_table = self.min_tables[element][j], self.max_tables[element][j]
+            mins[at_level] = np.fmin(min_table[start[at_level]], min_table[second_start[at_level]])
+            maxs[at_level] = np.fmax(max_table[start[at_level]], max_table[second_start[at_level]])
+        element_min[found] = mins
+        element_max[found] = maxs
+        return element_min, element_max
+
 
 # function to search df for RRs in predicted range
-def calculate_element_min_max(df, lipid_and_swiss_df, element, pred_interval):
+def calculate_element_min_max(df, lipid_and_swiss_df, element, pred_interval, lookup_index=None):
     min_col_name = f"{element}minpred_{pred_interval}"
     max_col_name = f"{element}maxpred_{pred_interval}"
 
-    df[min_col_name] = np.nan
-    df[max_col_name] = np.nan
+    if lookup_index is None:
+        lookup_index = RRLookupIndex(lipid_and_swiss_df, elements=[element])
+
+    df[min_col_name], df[max_col_name] = lookup_index.element_range(element, df['predLower'], df['predUpper'])
 
-    for i in range(len(df)):
-        lower_limit = df.iloc[i]['predLower']
-        upper_limit = df.iloc[i]['predUpper']
+    return df
 
-        subset_db = lipid_and_swiss_df[(lipid_and_swiss_df['RR21'] >= lower_limit) & (lipid_and_swiss_df['RR21'] <= upper_limit)]
 
-        if not subset_db.empty:
-            df.at[df.index[i], min_col_name] = subset_db[element].min()
-            df.at[df.index[i], max_col_name] = subset_db[element].max()
+def calculate_element_ranges(predictions, lookup_index, pred_interval):
+    '''
+    Element ranges of all elements in one pass over the same lookup index.
+
+    predictions: {element: DataFrame (or dict) with the predLower and predUpper of the RR model of that element}
+
+    Return
+    ======
+        DataFrame with {element}minpred_{pred_interval} and {element}maxpred_{pred_interval} for every element
+    '''
+    ranges = {}
+    for element, prediction in predictions.items():
+        ranges[f"{element}minpred_{pred_interval}"], ranges[f"{element}maxpred_{pred_interval}"] = lookup_index.element_range(
+            element, prediction['predLower'], prediction['predUpper'])
+    return pd.DataFrame(ranges)
+
+# Prediction interval constants of the R functions below, (nObs, MSE, avgMass, sumDiff) per relative ratio,
+# model with or without fractional mass (fc/nfc) and S
+RR_PREDICTION_INTERVALS = {
+    # with fractional mass (predRR.._agg_fc)
+    ('RR21', True, False): (62938, 0.0008415981, 0.8993654, 20986.82),
+    ('RR21', True, True): (2205, 0.0005122064, 1.069031, 447.149),
+    ('RR32', True, False): (62677, 0.0001134447, 0.9015365, 20910.98),
+    ('RR32', True, True): (2190, 0.003569434, 1.072511, 442.8918),
+    ('RR43', True, False): (62938, 7.642264e-05, 0.8993654, 20986.82),
+    ('RR43', True, True): (2205, 0.0002348063, 1.069031, 447.149),
+    ('RR54', True, False): (62677, 3.327013e-05, 0.9015365, 20910.98),
+    ('RR54', True, True): (2190, 0.0003063309, 1.072511, 442.8918),
+    # without fractional mass (predRR.._agg_nfc)
+    ('RR21', False, False): (62938, 0.001540977, 0.8993654, 20986.82),
+    ('RR21', False, True): (2205, 0.001172896, 1.069031, 447.149),
+    ('RR32', False, False): (62677, 0.00058191, 0.9015365, 20910.98),
+    ('RR32', False, True): (2190, 0.004651509, 1.072511, 442.8918),
+    ('RR43', False, False): (62938, 0.0001490671, 0.8993654, 20986.82),
+    ('RR43', False, True): (2205, 0.0003596577, 1.069031, 447.149),
+    ('RR54', False, False): (62677, 5.74326e-05, 0.9015365, 20910.98),
+    ('RR54', False, True): (2190, 0.0004727521, 1.072511, 442.8918),
+}
+
+
+def rr_model_json_path(model_path):
+    '''The exported .json next to an RR model .rds (export_rr_models.py).'''
+    return os.path.splitext(model_path)[0] + '.json'
+
+
+class RRModel:
+    '''
+    A fitted flexmix concomitant mixture of regressions (the .rds files in relative_ratios_no_fracmass and
+    update_relative_ratios) evaluated with numpy, no R needed. The coefficients are exported once to .json
+    by export_rr_models.py.
+
+    predict gives the same as predict(modelOutput, x, aggregate = TRUE)[[1]][,1] in R: the prediction of each
+    component weighted by the concomitant (multinomial logit) prior of every row.
+    '''
+    def __init__(self, model):
+        self.source = model['source']
+        self.response = model['response']
+        self.poly = model['poly']
+        self.component_terms = model['component_terms']
+        self.component_coef = np.array(model['component_coef'], dtype=np.float64).T # terms x components
+        self.concomitant_terms = model['concomitant_terms']
+        self.concomitant_coef = np.array(model['concomitant_coef'], dtype=np.float64) # terms x components
+        self.fractional_mass = 'fractionalMass' in self.concomitant_terms # the fc models
+
+    @classmethod
+    def from_json(cls, json_path):
+        with open(json_path) as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def from_rds_path(cls, model_path):
+        return cls.from_json(rr_model_json_path(model_path))
+
+    def __repr__(self):
+        return f"RRModel({self.source}, {self.response}, {self.component_coef.shape[1]} components)"
+
+    @property
+    def variables(self):
+        '''Input variables used by the model, e.g. ['m0', 'm32'].'''
+        variables = list(self.poly)
+        for term in self.component_terms + self.concomitant_terms:
+            if term != '(Intercept)' and not term.startswith('poly(') and term not in variables:
+                variables.append(term)
+        return variables
+
+    def _poly(self, variable, x):
+        # orthogonal polynomial of the fitted data (R predict.poly with the stored alpha and norm2)
+        degree, alpha, norm2 = self.poly[variable]['degree'], self.poly[variable]['alpha'], np.array(self.poly[variable]['norm2'])
+        Z = np.ones((len(x), degree + 1))
+        Z[:, 1] = x - alpha[0]
+        for i in range(1, degree):
+            Z[:, i + 1] = (x - alpha[i]) * Z[:, i] - (norm2[i + 1] / norm2[i]) * Z[:, i - 1]
+        Z = Z / np.sqrt(norm2[1:])
+        return Z[:, 1:]
+
+    def model_matrix(self, x, terms):
+        columns = []
+        polys = {}
+        for term in terms:
+            if term == '(Intercept)':
+                columns.append(np.ones(len(x)))
+            elif term.startswith('poly('): # e.g. poly(m0, 2)1
+                variable = term[len('poly('):term.index(',')]
+                if variable not in polys:
+                    polys[variable] = self._poly(variable, np.asarray(x[variable], dtype=np.float64))
+                columns.append(polys[variable][:, int(term[term.index(')') + 1:]) - 1])
+            else:
+                columns.append(np.asarray(x[term], dtype=np.float64))
+        return np.column_stack(columns)
+
+    def prior(self, x):
+        '''Concomitant prior of every component per row (rows sum to 1).'''
+        eta = self.model_matrix(x, self.concomitant_terms) @ self.concomitant_coef
+        eta = np.exp(eta - eta.max(axis=1, keepdims=True))
+        return eta / eta.sum(axis=1, keepdims=True)
+
+    def predict(self, x):
+        '''Aggregated RR prediction for x (DataFrame or dict with m0, m21, m32 and for the fc models fractionalMass).'''
+        component_predictions = self.model_matrix(x, self.component_terms) @ self.component_coef
+        return np.sum(component_predictions * self.prior(x), axis=1)
+
+
+def predict_rr(x, modelOutput, conf_int=True, conf_level=0.995, S=False):
+    '''
+    Numpy version of the R predRR.._agg_fc / predRR.._agg_nfc functions for an RRModel: x with pred and, for conf_int,
+    the prediction interval predLower and predUpper (constants from RR_PREDICTION_INTERVALS).
+    '''
+    output = pd.DataFrame(x).copy()
+    pred = modelOutput.predict(output)
+    output['pred'] = pred
+
+    if conf_int:
+        crit_val = NormalDist().inv_cdf(1 - (1 - conf_level) / 2)
+
+        nObs, MSE, avgMass, sumDiff = RR_PREDICTION_INTERVALS[(modelOutput.response, modelOutput.fractional_mass, S)]
+        predMassDiff = (output['m0'].to_numpy() - avgMass)**2
+        stdErr = np.sqrt(MSE*(1 + 1/nObs + predMassDiff/sumDiff))
+
+        output['predLower'] = pred - crit_val*stdErr
+        output['predUpper'] = pred + crit_val*stdErr
+
+    return output
+
+
+RR_MODEL_R_TOLERANCE = 1e-6 # largest allowed absolute difference of pred, predLower and predUpper to R
+
+
+def rr_model_r_check_path(model_path):
+    '''R predictions of an RR model on the check grid of export_rr_models.py, saved next to its .json.'''
+    return os.path.splitext(model_path)[0] + '.R_predictions.csv'
+
+
+def compare_rr_model_to_r(model, r_predictions, conf_level=0.995):
+    '''
+    Largest absolute difference of the numpy pred, predLower and predUpper (predict_rr) to the R predRR.._agg
+    output in r_predictions (DataFrame with the model inputs and pred, predLower and predUpper).
+    '''
+    S = '.S.' in model.source
+    numpy_predictions = predict_rr(x=r_predictions[model.variables], modelOutput=model, conf_int=True, conf_level=conf_level, S=S)
+    return max(float(np.max(np.abs(numpy_predictions[column].to_numpy() - r_predictions[column].to_numpy()), initial=0))
+               for column in ('pred', 'predLower', 'predUpper'))
+
+
+def check_rr_model_against_r(model_path, model=None, tolerance=RR_MODEL_R_TOLERANCE):
+    '''
+    Compares an RR model with the R predictions saved by export_rr_models.py, raises ValueError above tolerance.
+
+    Return
+    ======
+        the largest difference, None if there are no R predictions for the model yet
+    '''
+    check_path = rr_model_r_check_path(model_path)
+    if not os.path.exists(check_path):
+        return None
+    if model is None:
+        model = RRModel.from_json(model_path)
+    difference = compare_rr_model_to_r(model, pd.read_csv(check_path))
+    if not difference <= tolerance:
+        raise ValueError(f"{model_path} differs from R by {difference} (tolerance {tolerance}), export it again with export_rr_models.py")
+    return difference
+
+
+# RR model (exported .json) whose prediction interval gives the range of each element
+ELEMENT_RR_MODELS = {
+    "C": "relative_ratios_no_fracmass/resultRR21.noS.json",
+    "H": "update_relative_ratios/resultRR21_fractionalMass.noS.json",
+    "N": "relative_ratios_no_fracmass/resultRR21.noS.json",
+    "O": "update_relative_ratios/resultRR43_fractionalMass.noS.json",
+    "P": "update_relative_ratios/resultRR32_fractionalMass.noS.json"
+}
+
+# loaded once per process and kept for the next samples
+_rr_models = {}
+_rr_lookup_indexes = {}
+
+
+def load_rr_model(model_path):
+    if model_path not in _rr_models:
+        model = RRModel.from_json(model_path)
+        # checked against the R predictions once per process, if export_rr_models.py saved them
+        if check_rr_model_against_r(model_path, model) is None:
+            print(f"Warning: {model_path} is not checked against R yet (no {rr_model_r_check_path(model_path)}), run export_rr_models.py")
+        _rr_models[model_path] = model
+    return _rr_models[model_path]
+
+
+def load_rr_lookup_index(lookup_table_path, elements=('C', 'H', 'N', 'O', 'P')):
+    key = (lookup_table_path, tuple(elements))
+    if key not in _rr_lookup_indexes:
+        _rr_lookup_indexes[key] = RRLookupIndex(pd.read_csv(lookup_table_path), elements)
+    return _rr_lookup_indexes[key]
+
+
+def _rr_model_inputs(iso_pattern_df):
+    return pd.DataFrame({
+        'm0': iso_pattern_df['m0'].to_numpy(),
+        'm21': iso_pattern_df['m21'].to_numpy(),
+        'm32': iso_pattern_df['m32'].to_numpy(),
+        'fractionalMass': iso_pattern_df['frac_mass'].to_numpy() # only used by the fc models
+    })
+
+
+def predict_element_ranges(iso_pattern_df, lookup_index, pred_interval, element_models=None, S=False, grids=None, grid_method='linear',
+                           rr_backend='R'):
+    '''
+    All element ranges of the triples in one call. Each RR model is loaded once per process and predicted
+    once, elements sharing a model (C and N) share its prediction interval.
+
+    iso_pattern_df: triples with m0 (mass1/1000), m21, m32 and frac_mass
+    element_models: {element: model .json}, ELEMENT_RR_MODELS by default
+    grids: optional {model .json: RRGrid} (load_rr_grids), the prediction intervals of these models are then
+           looked up in the precomputed grid with grid_method ('nearest' or 'linear')
+    rr_backend: 'R' (the flexmix .rds next to the .json, predicted by predict_rr_with_r) or 'numpy' (RRModel from the .json,
+                no R needed, only use it once the model passes check_rr_model_against_r). The grids are built with numpy.
+
+    Return
+    ======
+        DataFrame with {element}minpred_{pred_interval} and {element}maxpred_{pred_interval} for every element,
+        in the row order of iso_pattern_df
+    '''
+    if element_models is None:
+        element_models = ELEMENT_RR_MODELS
+
+    toPred = _rr_model_inputs(iso_pattern_df)
+
+    model_predictions = {}
+    for model_path in dict.fromkeys(element_models.values()):
+        if grids is not None and model_path in grids:
+            predLower, predUpper = grids[model_path].predict_interval(toPred, grid_method)
+            model_predictions[model_path] = {'predLower': predLower, 'predUpper': predUpper}
+        elif rr_backend == 'R':
+            model_predictions[model_path] = predict_rr_with_r(toPred, model_path, conf_level=pred_interval, S=S)
+        elif rr_backend == 'numpy':
+            model_predictions[model_path] = predict_rr(x=toPred, modelOutput=load_rr_model(model_path), conf_int=True, conf_level=pred_interval, S=S)
         else:
-            df.at[df.index[i], min_col_name] = np.nan
-            df.at[df.index[i], max_col_name] = np.nan
+            raise ValueError(f"Unknown RR backend {rr_backend!r}, use 'R' or 'numpy'")
+
+    return calculate_element_ranges({element: model_predictions[model_path] for element, model_path in element_models.items()}, lookup_index, pred_interval)
+
+
+# (start, stop, number of points) of the RR grid axes, m0 is mass1/1000 and m21/m32 are around the 13C spacing
+DEFAULT_RR_GRID_AXES = {
+    'm0': (0.1, 2.0, 1901),
+    'm21': (0.9934, 1.0134, 101),
+    'm32': (0.9934, 1.0134, 101),
+    'fractionalMass': (0.0, 1.0, 51),
+}
 
-    return df
 
-# Concomitant models written in R for now
-ro.r('''
+class RRGrid:
+    '''
+    Prediction interval (predLower, predUpper) of one RR model precomputed on a regular grid over the inputs
+    the model uses (RRModel.variables). Saved as .npy (memory mapped when loaded) next to a .json with the axes.
+
+    The element ranges are still resolved exactly from the interpolated interval with the RRLookupIndex, which is
+    cheap, interpolating the integer element ranges themselves would not be meaningful.
+    Triples outside the grid are predicted exactly.
+    '''
+    def __init__(self, model, axes, values, pred_interval, S=False, model_hash=None):
+        self.model = model
+        self.variables = model.variables
+        self.axes = {variable: tuple(axes[variable]) for variable in self.variables}
+        self.values = values # (axis lengths..., 2) predLower and predUpper
+        self.pred_interval = pred_interval
+        self.S = S
+        self.model_hash = model_hash # sha1 of the model .json the grid was built from
+
+    def __repr__(self):
+        return f"RRGrid({self.model.source}, axes={self.axes}, pred_interval={self.pred_interval})"
+
+    @classmethod
+    def build(cls, model, pred_interval, axes=None, S=False, model_hash=None, chunk_size=1000000):
+        axes = dict(DEFAULT_RR_GRID_AXES, **(axes or {}))
+        variables = model.variables
+        points = [np.linspace(*axes[variable]) for variable in variables]
+        shape = tuple(len(axis_points) for axis_points in points)
+
+        values = np.empty(shape + (2,), dtype=np.float32)
+        flat_values = values.reshape(-1, 2)
+        for chunk_start in range(0, flat_values.shape[0], chunk_size):
+            cells = np.arange(chunk_start, min(chunk_start + chunk_size, flat_values.shape[0]))
+            coordinates = np.unravel_index(cells, shape)
+            x = pd.DataFrame({variable: points[d][coordinates[d]] for d, variable in enumerate(variables)})
+            prediction = predict_rr(x=x, modelOutput=model, conf_int=True, conf_level=pred_interval, S=S)
+            flat_values[cells, 0] = prediction['predLower'].to_numpy()
+            flat_values[cells, 1] = prediction['predUpper'].to_numpy()
+        return cls(model, axes, values, pred_interval, S, model_hash)
+
+    def save(self, grid_path):
+        np.save(grid_path + '.npy', self.values)
+        with open(grid_path + '.json', 'w') as f:
+            json.dump({'source': self.model.source, 'model_hash': self.model_hash, 'axes': self.axes, 'pred_interval': self.pred_interval, 'S': self.S}, f, indent=4)
+
+    @classmethod
+    def load(cls, grid_path, model, mmap=True):
+        with open(grid_path + '.json') as f:
+            meta = json.load(f)
+        values = np.load(grid_path + '.npy', mmap_mode='r' if mmap else None)
+        return cls(model, meta['axes'], values, meta['pred_interval'], meta['S'], meta.get('model_hash'))
+
+    def predict_interval(self, x, method='linear'):
+        '''predLower and predUpper for every row of x, by 'nearest' grid point or 'linear' (multilinear) interpolation.'''
+        positions = []
+        inside = np.ones(len(x), dtype=bool)
+        for variable in self.variables:
+            start, stop, n = self.axes[variable]
+            position = (np.asarray(x[variable], dtype=np.float64) - start) / ((stop - start) / (n - 1))
+            inside &= (position >= 0) & (position <= n - 1)
+            positions.append(position)
+        shape = self.values.shape[:-1]
+
+        if method == 'nearest':
+            cells = tuple(np.clip(np.rint(position), 0, n - 1).astype(np.int64) for position, n in zip(positions, shape))
+            interval = np.asarray(self.values[cells], dtype=np.float64)
+        elif method == 'linear':
+            lower_cells = [np.clip(np.floor(position), 0, n - 2).astype(np.int64) for position, n in zip(positions, shape)]
+            fractions = [position - cell for position, cell in zip(positions, lower_cells)]
+            interval = np.zeros((len(x), 2))
+            for corner in itertools.product((0, 1), repeat=len(shape)):
+                weight = np.ones(len(x))
+                for fraction, side in zip(fractions, corner):
+                    weight *= fraction if side else 1 - fraction
+                interval += weight[:, None] * self.values[tuple(cell + side for cell, side in zip(lower_cells, corner))]
+        else:
+            raise ValueError(f"Unknown grid method {method!r}, use 'nearest' or 'linear'")
+
+        if not np.all(inside): # outside the grid: exact prediction
+            outside = ~inside
+            prediction = predict_rr(x=pd.DataFrame(x)[outside], modelOutput=self.model, conf_int=True, conf_level=self.pred_interval, S=self.S)
+            interval[outside, 0] = prediction['predLower'].to_numpy()
+            interval[outside, 1] = prediction['predUpper'].to_numpy()
+        return interval[:, 0], interval[:, 1]
+
+
+_rr_grids = {}
+
+
+def rr_grid_path(grid_folder, model_path, pred_interval, S=False):
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(grid_folder, f"{name}_{pred_interval}{'_S' if S else ''}")
+
+
+def load_rr_grids(grid_folder, pred_interval, element_models=None, axes=None, S=False):
+    '''
+    {model .json: RRGrid} for the models of element_models, kept once per process. A grid missing from grid_folder,
+    saved with other axes or built from another version of the model .json (file hash), is built and saved first
+    (this takes a while, once).
+    '''
+    if element_models is None:
+        element_models = ELEMENT_RR_MODELS
+    axes = dict(DEFAULT_RR_GRID_AXES, **(axes or {}))
+    os.makedirs(grid_folder, exist_ok=True)
+
+    grids = {}
+    for model_path in dict.fromkeys(element_models.values()):
+        model = load_rr_model(model_path)
+        grid_path = rr_grid_path(grid_folder, model_path, pred_interval, S)
+        model_axes = {variable: tuple(axes[variable]) for variable in model.variables}
+        model_hash = file_hash(model_path)
+        grid = _rr_grids.get(grid_path)
+        if grid is None or grid.axes != model_axes or grid.model_hash != model_hash:
+            grid = RRGrid.load(grid_path, model) if os.path.exists(grid_path + '.json') else None
+            if grid is None or grid.axes != model_axes or grid.model_hash != model_hash:
+                print(f"Building RR grid {grid_path}...")
+                RRGrid.build(model, pred_interval, axes, S, model_hash).save(grid_path)
+                grid = RRGrid.load(grid_path, model)
+            _rr_grids[grid_path] = grid
+        grids[model_path] = grid
+    return grids
+
+
+def validate_rr_grids(iso_pattern_df, lookup_index, pred_interval, grids, element_models=None, S=False, grid_method='linear'):
+    '''
+    Compares the grid lookup with the exact prediction on the given triples.
+
+    Return
+    ======
+        DataFrame with one row per element: the largest predLower/predUpper difference of its model, the number of
+        triples outside the grid and the fraction of triples whose element min and max are the same as the exact ones
+    '''
+    if element_models is None:
+        element_models = ELEMENT_RR_MODELS
+
+    toPred = _rr_model_inputs(iso_pattern_df)
+    exact = predict_element_ranges(iso_pattern_df, lookup_index, pred_interval, element_models, S, rr_backend='numpy')
+    from_grid = predict_element_ranges(iso_pattern_df, lookup_index, pred_interval, element_models, S, grids, grid_method, rr_backend='numpy')
+
+    report = []
+    for element, model_path in element_models.items():
+        grid = grids[model_path]
+        exact_prediction = predict_rr(x=toPred, modelOutput=grid.model, conf_int=True, conf_level=pred_interval, S=S)
+        predLower, predUpper = grid.predict_interval(toPred, grid_method)
+        inside = np.ones(len(toPred), dtype=bool)
+        for variable, (start, stop, n) in grid.axes.items():
+            inside &= (toPred[variable] >= start).to_numpy() & (toPred[variable] <= stop).to_numpy()
+
+        min_col_name = f"{element}minpred_{pred_interval}"
+        max_col_name = f"{element}maxpred_{pred_interval}"
+        same_min = (exact[min_col_name] == from_grid[min_col_name]) | (exact[min_col_name].isna() & from_grid[min_col_name].isna())
+        same_max = (exact[max_col_name] == from_grid[max_col_name]) | (exact[max_col_name].isna() & from_grid[max_col_name].isna())
+        report.append({
+            'element': element, 'model': grid.model.source, 'method': grid_method, 'triples': len(toPred),
+            'outside_grid': int((~inside).sum()),
+            'max_predLower_diff': float(np.max(np.abs(predLower - exact_prediction['predLower'].to_numpy()), initial=0)),
+            'max_predUpper_diff': float(np.max(np.abs(predUpper - exact_prediction['predUpper'].to_numpy()), initial=0)),
+            'same_min': float(same_min.mean()) if len(toPred) else 1.0,
+            'same_max': float(same_max.mean()) if len(toPred) else 1.0,
+        })
+    return pd.DataFrame(report)
+
+
+# The original concomitant models written in R, only used to compare against the numpy version.
+# R (rpy2 + flexmix) is started the first time one of them is used.
+R_PREDICTION_FUNCTIONS = '''
 #functions
 predRR21_agg_fc <- function(x, modelOutput, conf.int = TRUE, conf.level=conf.level, S=FALSE){
   
@@ -346,17 +826,63 @@ predRR54_agg_nfc <- function(x, modelOutput, conf.int = TRUE, conf.level=conf.le
   
 }
 
-''')
+'''
+
+R_PREDICTION_FUNCTION_NAMES = ['predRR21_agg_fc', 'predRR32_agg_fc', 'predRR43_agg_fc', 'predRR54_agg_fc',
+                               'predRR21_agg_nfc', 'predRR32_agg_nfc', 'predRR43_agg_nfc', 'predRR54_agg_nfc']
+
+_r_predictors = None
+
+
+def load_r_predictors():
+    global _r_predictors
+    if _r_predictors is None:
+        import rpy2.robjects as ro
+        from rpy2.robjects.packages import importr
+        importr('flexmix')
+        ro.r(R_PREDICTION_FUNCTIONS)
+        _r_predictors = {name: ro.globalenv[name] for name in R_PREDICTION_FUNCTION_NAMES}
+    return _r_predictors
+
+
+_r_rr_models = {}
+
+
+def rr_model_rds_path(model_path):
+    '''The flexmix .rds an RR model .json was exported from.'''
+    return os.path.splitext(model_path)[0] + '.rds'
+
+
+def predict_rr_with_r(x, model_path, conf_level=0.995, S=False):
+    '''
+    Prediction interval of the flexmix model (.rds of model_path) with the R predRR.._agg functions above, as Step 2 did
+    before the numpy RRModel. The .rds is read once per process.
+
+    Return
+    ======
+        DataFrame with pred, predLower and predUpper in the row order of x
+    '''
+    import rpy2.robjects as ro
+    from rpy2.robjects import pandas2ri
 
-predRR21_agg_fc = ro.globalenv['predRR21_agg_fc']
-predRR32_agg_fc = ro.globalenv['predRR32_agg_fc']
-predRR43_agg_fc = ro.globalenv['predRR43_agg_fc']
-predRR54_agg_fc = ro.globalenv['predRR54_agg_fc']
+    r_predictors = load_r_predictors()
+    rds_path = rr_model_rds_path(model_path)
+    if rds_path not in _r_rr_models:
+        _r_rr_models[rds_path] = ro.r['readRDS'](rds_path)
 
-predRR21_agg_nfc = ro.globalenv['predRR21_agg_nfc']
-predRR32_agg_nfc = ro.globalenv['predRR32_agg_nfc']
-predRR43_agg_nfc = ro.globalenv['predRR43_agg_nfc']
-predRR54_agg_nfc = ro.globalenv['predRR54_agg_nfc']
+    name = os.path.basename(rds_path)
+    fractional_mass = 'fractionalMass' in name
+    function = r_predictors[f"pred{re.search(r'RR[0-9]{2}', name).group(0)}_agg_{'fc' if fractional_mass else 'nfc'}"]
+    toPred = pd.DataFrame(x)[['m0', 'm21', 'm32'] + (['fractionalMass'] if fractional_mass else [])].reset_index(drop=True)
 
+    with (ro.default_converter + pandas2ri.converter).context():
+        resRR = function(ro.conversion.get_conversion().py2rpy(toPred), _r_rr_models[rds_path], **{'conf.int': True, 'conf.level': conf_level, 'S': S})
+        resRR_df = ro.conversion.get_conversion().rpy2py(resRR)
+    return pd.DataFrame(resRR_df)[['pred', 'predLower', 'predUpper']].reset_index(drop=True)
 
 
+def __getattr__(name):
+    # predRR21_agg_fc etc. are still importable from here, without starting R on import
+    if name in R_PREDICTION_FUNCTION_NAMES:
+        return load_r_predictors()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
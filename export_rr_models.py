@@ -0,0 +1,85 @@
+import glob
+import json
+import sys
+import numpy as np
+import pandas as pd
+import rpy2.robjects as ro
+from rpy2.robjects import pandas2ri
+from rpy2.robjects.packages import importr
+
+from element_range_pred import RR_MODEL_R_TOLERANCE, RRModel, compare_rr_model_to_r, load_r_predictors, rr_model_json_path, rr_model_r_check_path
+
+# Exports the coefficients of the flexmix RR models (.rds) to .json next to them, read by element_range_pred.RRModel.
+# Only needed again when the models are refitted, the pipeline itself does not need R for the RR prediction.
+# The R predictions on a check grid are saved as .R_predictions.csv next to every .json, the script exits with an error
+# when numpy and R differ by more than RR_MODEL_R_TOLERANCE (the pipeline then also refuses to load that model).
+
+flexmix = importr('flexmix')
+
+ro.r('''
+export_flexmix <- function(modelOutput){
+  predvars <- as.list(attr(modelOutput@model[[1]]@terms, "predvars"))[-(1:2)]
+  poly <- list()
+  for (term in predvars){
+    if (is.call(term) && as.character(term[[1]]) == "poly"){
+      poly[[as.character(term[[2]])]] <- list(degree = eval(term[[3]]), alpha = term$coefs$alpha, norm2 = term$coefs$norm2)
+    }
+  }
+  concomitantCoef <- modelOutput@concomitant@coef
+  list(response = as.character(attr(modelOutput@model[[1]]@terms, "variables")[[2]]),
+       poly = poly,
+       component_terms = names(modelOutput@components[[1]][[1]]@parameters$coef),
+       component_coef = lapply(modelOutput@components, function(comp) unname(comp[[1]]@parameters$coef)),
+       concomitant_terms = rownames(concomitantCoef),
+       concomitant_coef = lapply(seq_len(nrow(concomitantCoef)), function(i) unname(concomitantCoef[i, ])))
+}
+''')
+
+export_flexmix = ro.globalenv['export_flexmix']
+readRDS = ro.r['readRDS']
+r_predictors = load_r_predictors()
+
+model_paths = sorted(glob.glob('relative_ratios_no_fracmass/resultRR*.rds') + glob.glob('update_relative_ratios/resultRR*.rds'))
+
+failed = []
+for model_path in model_paths:
+    fModel = readRDS(model_path)
+    exported = export_flexmix(fModel)
+    poly = exported.rx2('poly')
+
+    model = {
+        'source': model_path.split('/')[-1],
+        'response': exported.rx2('response')[0],
+        'poly': {variable: {'degree': int(spec.rx2('degree')[0]), 'alpha': list(spec.rx2('alpha')), 'norm2': list(spec.rx2('norm2'))}
+                 for variable, spec in (zip(poly.names, poly) if len(poly) else [])},
+        'component_terms': list(exported.rx2('component_terms')),
+        'component_coef': [list(coef) for coef in exported.rx2('component_coef')],
+        'concomitant_terms': list(exported.rx2('concomitant_terms')),
+        'concomitant_coef': [list(coef) for coef in exported.rx2('concomitant_coef')],
+    }
+
+    with open(rr_model_json_path(model_path), 'w') as f:
+        json.dump(model, f, indent=4)
+
+    # R predictions (predRR.._agg, as used before Step 2 was moved to numpy) on a grid covering the lipid masses,
+    # saved next to the .json and checked by element_range_pred.load_rr_model from then on
+    m0 = np.linspace(0.2, 1.6, 141)
+    check_df = pd.DataFrame({'m0': np.repeat(m0, 9), 'm21': np.tile(np.repeat([0.995, 1.0, 1.005], 3), len(m0)),
+                             'm32': np.tile([0.995, 1.0, 1.005], 3 * len(m0))})
+    check_df['fractionalMass'] = (check_df['m0'] * 1000) % 1
+    rr_model = RRModel.from_json(rr_model_json_path(model_path))
+    r_predictor = r_predictors[f"pred{rr_model.response}_agg_{'fc' if rr_model.fractional_mass else 'nfc'}"]
+    with (ro.default_converter + pandas2ri.converter).context():
+        r_output = r_predictor(ro.conversion.get_conversion().py2rpy(check_df), fModel, **{'conf.int': True, 'conf.level': 0.995, 'S': '.S.' in rr_model.source})
+        r_output = ro.conversion.get_conversion().rpy2py(r_output)
+    check_df[['pred', 'predLower', 'predUpper']] = np.asarray(r_output[['pred', 'predLower', 'predUpper']], dtype=np.float64)
+    check_df.to_csv(rr_model_r_check_path(rr_model_json_path(model_path)), index=False)
+
+    difference = compare_rr_model_to_r(rr_model, check_df)
+    print(model_path, '-> json, max abs difference to R:', difference)
+    if not difference <= RR_MODEL_R_TOLERANCE:
+        failed.append(model_path)
+
+if failed:
+    sys.exit(f"Numpy prediction differs from R by more than {RR_MODEL_R_TOLERANCE} for: {', '.join(failed)}")
+print('All RR models match R within', RR_MODEL_R_TOLERANCE)
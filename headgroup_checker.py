@@ -1,28 +1,36 @@
 import pandas as pd
+import numpy as np
 import ast
 import re
+from functools import lru_cache
 
 
-# Function to parse the headgroup, DB, and additional O
-def parse_entry(a, b):
-    if not isinstance(a, str):
-        return None, None, None
+# Headgroup, DB and additional O of an abbreviation, parsed once per unique abbreviation
+@lru_cache(maxsize=None)
+def parse_abbreviation(a):
     headgroup_match = re.search(r'^(.*?O-)' if 'O-' in a else r'^(.*?)(?=\s*X|:|;|$)', a)
     headgroup = headgroup_match.group(1).strip() if headgroup_match else ''
     db_match = re.search(r':(\d+)', a)
-    db = int(db_match.group(1)) + b if db_match else b
+    db = int(db_match.group(1)) if db_match else 0
     additional_o_match = re.search(r';O(\d*)', a)
     additional_o = int(additional_o_match.group(1)) if additional_o_match and additional_o_match.group(1) else 0 if additional_o_match else 0
 
     return headgroup, db, additional_o
 
+# Function to parse the headgroup, DB, and additional O
+def parse_entry(a, b):
+    if not isinstance(a, str):
+        return None, None, None
+    headgroup, db, additional_o = parse_abbreviation(a)
+
+    return headgroup, db + b, additional_o
+
 # Function to convert a chemical formula to a dictionary
 def formula_to_dict(formula):
     matches = re.findall(r'([A-Z][a-z]*)(\d*)', formula)
     return {element: int(count) if count else 1 for (element, count) in matches}
 
-def subtract_formula_and_validate(key_formula, chem_formula, chains, db):
-    key_dict, chem_dict = formula_to_dict(key_formula), formula_to_dict(chem_formula)
+def subtract_counts_and_validate(key_dict, chem_dict, chains, db):
     for elem in ['N', 'O', 'P', 'S']:
         if key_dict.get(elem, 0) != chem_dict.get(elem, 0):
             return None, elem
@@ -35,45 +43,92 @@ def subtract_formula_and_validate(key_formula, chem_formula, chains, db):
     else:
         return None, 'invalid_subtraction'
 
-# Function to subtract the formula, chains, and validate C and H
-def check_heads(df, headgroup_db):
+def subtract_formula_and_validate(key_formula, chem_formula, chains, db):
+    return subtract_counts_and_validate(formula_to_dict(key_formula), formula_to_dict(chem_formula), chains, db)
+
+HEADGROUP_ELEMENTS = ['C', 'H', 'N', 'O', 'P', 'S']
 
-    df['Non-Empty Keys Count'] = 0
-    df['Accepted Keys Count'] = 0
-    df['Unique Lipids Count'] = 0
-    df['Unique Lipids List'] = None
-    
-    for index, row in df.iterrows():
-        row_dict = row['Formula:subclass combos']
+# Element counts of formulas as integer columns, each unique formula parsed once
+def formula_count_table(formulas, prefix=''):
+    codes, unique_formulas = pd.factorize(pd.Series(formulas, dtype=object))
+    unique_counts = np.array([[counts.get(element, 0) for element in HEADGROUP_ELEMENTS] for counts in map(formula_to_dict, unique_formulas)], 
+                             dtype=np.int64).reshape(len(unique_formulas), len(HEADGROUP_ELEMENTS))
+    return pd.DataFrame(unique_counts[codes], columns=[prefix + element for element in HEADGROUP_ELEMENTS])
+
+# Headgroup database as a table keyed by (headgroup, additional_o) with the chem formula as counts, first row kept as with the filter before
+def build_headgroup_table(headgroup_db):
+    headgroup_db = headgroup_db[np.array([isinstance(headgroup, str) for headgroup in headgroup_db['class']], dtype=bool) & headgroup_db['additional O'].notna().to_numpy()]
+    headgroup_table = pd.DataFrame({'headgroup': headgroup_db['class'].to_numpy(), 'additional_o': headgroup_db['additional O'].astype(int).to_numpy(),
+                                    'chains': headgroup_db['chains'].to_numpy()})
+    headgroup_table = pd.concat([headgroup_table, formula_count_table(headgroup_db['chem'], prefix='chem_')], axis=1)
+    return headgroup_table.drop_duplicates(['headgroup', 'additional_o']).reset_index(drop=True)
+
+# One row per (formula, subclass) pair of the 'Formula:subclass combos' dicts, with the position of the row they came from
+def explode_subclass_combos(df):
+    positions, keys, abbreviations, ns = [], [], [], []
+    has_combos = np.zeros(len(df), dtype=bool)
+    non_empty_keys_counts = np.zeros(len(df), dtype=np.int64)
+
+    for position, row_dict in enumerate(df['Formula:subclass combos']):
         if not row_dict:
             continue
-        
-        non_empty_keys_count = sum(1 for k, v in row_dict.items() if v)
-        accepted_keys = set()
-        unique_lipids = set()
-        
+        has_combos[position] = True
         for key, entries in row_dict.items():
             if entries:
-                for entry in entries:
-                    a, b, c = entry
-                    headgroup, db, additional_o = parse_entry(a, b)
-                    if headgroup is None:
-                        continue
-
-                    match = headgroup_db[(headgroup_db['class'] == headgroup) & (headgroup_db['additional O'] == additional_o)]
-                    if not match.empty:
-                        chem_formula, chains = match.iloc[0]['chem'], match.iloc[0]['chains']
-                        remaining_elements, issue = subtract_formula_and_validate(key, chem_formula, chains, db)
-                        if remaining_elements and issue is None:
-                            accepted_keys.add(key)
-                            final_c = remaining_elements['C'] + 1
-                            final_lipid = f"{headgroup} {final_c}:{db};O{additional_o}" if additional_o > 0 else f"{headgroup} {final_c}:{db}"
-                            unique_lipids.add(final_lipid)
-        
-        df.at[index, 'Non-Empty Keys Count'] = non_empty_keys_count
-        df.at[index, 'Accepted Keys Count'] = len(accepted_keys)
-        df.at[index, 'Unique Lipids Count'] = len(unique_lipids)
-        df.at[index, 'Unique Lipids List'] = list(unique_lipids)
+                non_empty_keys_counts[position] += 1
+                for a, b, c in entries:
+                    positions.append(position)
+                    keys.append(key)
+                    abbreviations.append(a)
+                    ns.append(b)
+
+    candidates = pd.DataFrame({'position': np.array(positions, dtype=np.int64), 'key': pd.Series(keys, dtype=object), 
+                               'abbreviation': pd.Series(abbreviations, dtype=object), 'n': np.array(ns, dtype=np.int64)})
+    return candidates, has_combos, non_empty_keys_counts
+
+# Headgroup, chains and C/H rule checked for all candidates at once, returns the accepted ones with their lipid name
+def validate_candidates(candidates, headgroup_table):
+    candidates = candidates[np.array([isinstance(a, str) for a in candidates['abbreviation']], dtype=bool)].reset_index(drop=True)
+    parsed = [parse_abbreviation(a) for a in candidates['abbreviation']] # cached per unique abbreviation
+    candidates['headgroup'] = pd.Series([headgroup for headgroup, db, additional_o in parsed], dtype=object)
+    candidates['db'] = np.array([db for headgroup, db, additional_o in parsed], dtype=np.int64) + candidates['n'].to_numpy()
+    candidates['additional_o'] = np.array([additional_o for headgroup, db, additional_o in parsed], dtype=np.int64)
+    candidates = pd.concat([candidates, formula_count_table(candidates['key'])], axis=1)
+
+    candidates = candidates.merge(headgroup_table, on=['headgroup', 'additional_o'], how='inner')
+
+    accepted = np.ones(len(candidates), dtype=bool)
+    for element in ['N', 'O', 'P', 'S']:
+        accepted &= candidates[element].to_numpy() == candidates['chem_' + element].to_numpy()
+    accepted &= (candidates['C'].to_numpy() >= candidates['chem_C'].to_numpy()) & (candidates['H'].to_numpy() >= candidates['chem_H'].to_numpy())
+    remaining_C = candidates['C'] - candidates['chem_C']
+    remaining_H = candidates['H'] - candidates['chem_H'] - candidates['chains']
+    accepted &= (remaining_H == 2 * remaining_C - 2 * candidates['db']).to_numpy()
+
+    candidates = candidates[accepted].copy()
+    final_c = (remaining_C[accepted] + 1).astype(str)
+    candidates['lipid'] = (candidates['headgroup'] + ' ' + final_c + ':' + candidates['db'].astype(str) 
+                           + np.where(candidates['additional_o'] > 0, ';O' + candidates['additional_o'].astype(str), ''))
+    return candidates[['position', 'key', 'lipid']]
+
+# Function to subtract the formula, chains, and validate C and H
+def check_heads(df, headgroup_db):
+    headgroup_table = headgroup_db if 'chem_C' in headgroup_db.columns else build_headgroup_table(headgroup_db)
+
+    candidates, has_combos, non_empty_keys_counts = explode_subclass_combos(df)
+    accepted = validate_candidates(candidates, headgroup_table)
+
+    accepted_keys_counts = accepted.groupby('position')['key'].nunique()
+    unique_lipids = accepted.drop_duplicates(['position', 'lipid']).groupby('position')['lipid'].agg(list)
+
+    unique_lipids_lists = [[] if has else None for has in has_combos]
+    for position, lipids in unique_lipids.items():
+        unique_lipids_lists[position] = lipids
+
+    df['Non-Empty Keys Count'] = non_empty_keys_counts
+    df['Accepted Keys Count'] = accepted_keys_counts.reindex(range(len(df)), fill_value=0).to_numpy()
+    df['Unique Lipids Count'] = unique_lipids.map(len).reindex(range(len(df)), fill_value=0).to_numpy()
+    df['Unique Lipids List'] = pd.Series(unique_lipids_lists, index=df.index, dtype=object)
 
     return df
 
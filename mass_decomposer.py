@@ -0,0 +1,404 @@
+import numpy as np
+import pandas as pd
+import multiprocessing
+import os
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# largest counts of the enumerated elements in the lookup table, grown automatically if a query asks for more
+TABLE_MAX_COUNTS = {'C': 150, 'N': 10, 'O': 30, 'P': 5, 'S': 5}
+DEFAULT_TABLE_MAX_COUNT = 10
+
+
+def read_atom_masses(masses_path):
+    '''
+    Element symbols and masses from an imsdecomp masses file (e.g. res/atom-mono.masses),
+    commented out elements (lines starting with #) are skipped.
+    '''
+    atom_masses = {}
+    with open(masses_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            element, mass = line.split()[:2]
+            atom_masses[element] = float(mass)
+    return atom_masses
+
+
+def hill_order(elements):
+    '''C and H first, then the other elements alphabetically.'''
+    return sorted(elements, key=lambda element: (element != 'C', element != 'H', element))
+
+
+class MassDecomposer:
+    '''
+    Bounded mass decomposition in process, replacing the imsdecomp calls.
+
+    Built once per element set: the lightest element (H for CHNOP) is solved for, and all combinations
+    of the other elements up to TABLE_MAX_COUNTS are kept in a table sorted by mass.
+    A query then needs one np.searchsorted window per allowed count of the lightest element,
+    the candidates are checked against the element bounds and the exact mass error.
+    '''
+    def __init__(self, atom_masses, elements=None, table_max_counts=None):
+        if elements is None:
+            elements = list(atom_masses)
+        self.elements = list(elements)
+        self.masses = np.array([atom_masses[element] for element in self.elements], dtype=np.float64)
+        self.formula_order = [self.elements.index(element) for element in hill_order(self.elements)]
+
+        # identifies the atom mass table, cached decompositions are only reused for the same elements and masses
+        self.masses_hash = hashlib.sha1(repr(list(zip(self.elements, self.masses.tolist()))).encode()).hexdigest()
+
+        self.solved = int(np.argmin(self.masses)) # position of the lightest element
+        self.enumerated = [i for i in range(len(self.elements)) if i != self.solved]
+
+        max_counts = dict(TABLE_MAX_COUNTS, **(table_max_counts or {}))
+        self._build_table([max_counts.get(self.elements[i], DEFAULT_TABLE_MAX_COUNT) for i in self.enumerated])
+
+    @classmethod
+    def from_masses_file(cls, masses_path, elements=None, table_max_counts=None):
+        return cls(read_atom_masses(masses_path), elements, table_max_counts)
+
+    def _build_table(self, max_counts):
+        grids = np.meshgrid(*[np.arange(max_count + 1, dtype=np.int32) for max_count in max_counts], indexing='ij')
+        table_counts = np.stack([grid.ravel() for grid in grids], axis=1)
+        table_mass = table_counts @ self.masses[self.enumerated]
+        order = np.argsort(table_mass, kind='stable')
+        self.table_counts = table_counts[order]
+        self.table_mass = table_mass[order]
+        self.table_max_counts = np.array(max_counts, dtype=np.int64)
+
+    def __repr__(self):
+        return f"MassDecomposer(elements={self.elements}, table size={len(self.table_mass)})"
+
+    def _bounds_vector(self, bounds, default):
+        if bounds is None:
+            bounds = {}
+        if isinstance(bounds, dict):
+            return np.array([int(bounds.get(element, default)) for element in self.elements], dtype=np.int64)
+        return np.asarray(bounds, dtype=np.int64)
+
+    def formula_masses(self, counts):
+        '''Exact masses of an (n, elements) count matrix.'''
+        return np.asarray(counts, dtype=np.float64) @ self.masses
+
+    def formula_strings(self, counts):
+        '''Formula strings in Hill order with every non-zero count written out, e.g. C41H81N1O8P1.'''
+        symbols = [self.elements[i] for i in self.formula_order]
+        return [''.join(f"{symbol}{count}" for symbol, count in zip(symbols, row) if count) for row in np.asarray(counts)[:, self.formula_order].tolist()]
+
+    def decompose_counts(self, mass, lower_bounds=None, upper_bounds=None, mass_error=5, error_unit='ppm', max_decompositions=None):
+        '''Same as decompose but only returns the (n, elements) count matrix and the exact masses.'''
+        mass = float(mass)
+        allowed_error = mass * mass_error * 0.000001 if error_unit == 'ppm' else float(mass_error)
+
+        lower = np.maximum(self._bounds_vector(lower_bounds, 0), 0)
+        upper = self._bounds_vector(upper_bounds, -1)
+        unbounded = upper < 0
+        upper[unbounded] = np.floor((mass + allowed_error) / self.masses[unbounded]).astype(np.int64) # no element can exceed the mass
+
+        if np.any(upper[self.enumerated] > self.table_max_counts): # grow the table once for larger queries
+            self._build_table(np.maximum(upper[self.enumerated], self.table_max_counts))
+
+        solved_counts = np.arange(lower[self.solved], upper[self.solved] + 1)
+        residual = mass - solved_counts * self.masses[self.solved] # mass left for the enumerated elements
+        pad = 1e-6 # table masses are summed in a different order, the exact error test is done below
+        start = np.searchsorted(self.table_mass, residual - allowed_error - pad, side='left')
+        end = np.searchsorted(self.table_mass, residual + allowed_error + pad, side='right')
+        window_sizes = end - start
+
+        solved_counts = np.repeat(solved_counts, window_sizes)
+        table_rows = np.arange(len(solved_counts)) + np.repeat(start - (np.cumsum(window_sizes) - window_sizes), window_sizes)
+
+        counts = np.zeros((len(table_rows), len(self.elements)), dtype=np.int64)
+        counts[:, self.solved] = solved_counts
+        counts[:, self.enumerated] = self.table_counts[table_rows]
+        counts = counts[np.all((counts >= lower) & (counts <= upper), axis=1)]
+
+        exact_mass = self.formula_masses(counts)
+        within_error = np.abs(exact_mass - mass) <= allowed_error
+        counts = counts[within_error]
+        exact_mass = exact_mass[within_error]
+
+        order = np.lexsort(counts.T[::-1])
+        if max_decompositions is not None:
+            order = order[:max_decompositions]
+        return counts[order], exact_mass[order]
+
+    def decompose(self, mass, lower_bounds=None, upper_bounds=None, mass_error=5, error_unit='ppm', max_decompositions=None):
+        '''
+        All formulas with lower_bounds <= counts <= upper_bounds and |exact mass - mass| <= allowed error
+        (same query as imsdecomp -m mass -b lower -g upper -e mass_error -u error_unit).
+
+        lower_bounds, upper_bounds: {element: count} (missing elements 0 and unbounded) or vectors in self.elements order.
+        error_unit: 'ppm' or 'Da'.
+
+        Return
+        ======
+            DataFrame with one column of counts per element, 'formula', 'exact_mass' and 'ppm_error',
+            ordered by element counts.
+        '''
+        mass = float(mass)
+        counts, exact_mass = self.decompose_counts(mass, lower_bounds, upper_bounds, mass_error, error_unit, max_decompositions)
+
+        decompositions = pd.DataFrame(counts, columns=self.elements)
+        decompositions['formula'] = self.formula_strings(counts)
+        decompositions['exact_mass'] = exact_mass
+        decompositions['ppm_error'] = (exact_mass - mass) / mass * 1e6
+        return decompositions
+
+
+def format_decompositions(decompositions):
+    '''imsdecomp style lines "formula (exact mass)", as the -s option printed them.'''
+    return [f"{formula} ({exact_mass:.6f})" for formula, exact_mass in zip(decompositions['formula'], decompositions['exact_mass'])]
+
+
+_worker_decomposer = None # the shared decomposer inside a worker process
+
+
+def _init_decomposition_worker(decomposer):
+    global _worker_decomposer
+    _worker_decomposer = decomposer
+
+
+def _decompose_chunk(query_positions, masses, lower_bounds, upper_bounds, mass_errors, error_unit):
+    # runs in a worker: decomposes a chunk of queries and sends the results back as flat arrays
+    decomposition_counts = np.zeros(len(query_positions), dtype=np.int64)
+    counts, exact_masses = [], []
+    for i in range(len(query_positions)):
+        query_counts, query_exact_masses = _worker_decomposer.decompose_counts(masses[i], lower_bounds[i], upper_bounds[i], mass_errors[i], error_unit)
+        decomposition_counts[i] = len(query_counts)
+        counts.append(query_counts)
+        exact_masses.append(query_exact_masses)
+    n_elements = len(_worker_decomposer.elements)
+    return (query_positions, decomposition_counts, np.concatenate(counts) if counts else np.empty((0, n_elements), dtype=np.int64),
+            np.concatenate(exact_masses) if exact_masses else np.empty(0))
+
+
+class DecompositionCache:
+    '''
+    Persistent cache of decompositions, keyed on (mass bin, mass error, element min/max vector, atom mass table hash).
+
+    An entry holds every decomposition of its mass bin, widened by the largest allowed error inside the bin,
+    so any query mass falling in the bin is answered by filtering the entry to the exact error window of that mass.
+    The results are identical to decomposing the query directly.
+    Entries live in an in-memory LRU (OrderedDict) in front of a sqlite file that survives across runs,
+    cache_path=None keeps the cache in memory only. The LRU is capped by the bytes of its arrays (max_memory_bytes),
+    an entry of a high mass with wide element bounds can hold many decompositions, and every batch worker has its own LRU.
+    '''
+    def __init__(self, decomposer, cache_path=None, bin_width=0.005, max_memory_bytes=64 * 1024**2):
+        self.decomposer = decomposer
+        self.bin_width = bin_width
+        self.max_memory_bytes = max_memory_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = None
+        if cache_path is not None:
+            if os.path.dirname(cache_path):
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            self.connection = sqlite3.connect(cache_path, timeout=60) # the sample workers of a batch share the file
+            self.connection.execute("CREATE TABLE IF NOT EXISTS decompositions (key TEXT PRIMARY KEY, counts BLOB, exact_mass BLOB)")
+
+    def __repr__(self):
+        return (f"DecompositionCache(bin_width={self.bin_width}, in memory={len(self.memory)} ({self.memory_bytes / 1024**2:.1f} MB), "
+                f"hits={self.hits}, misses={self.misses})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def key(self, mass, lower_bounds, upper_bounds, mass_error, error_unit='ppm'):
+        mass_bin = int(np.floor(mass / self.bin_width))
+        lower = ','.join(str(int(count)) for count in lower_bounds)
+        upper = ','.join(str(int(count)) for count in upper_bounds)
+        return f"{self.decomposer.masses_hash}|{self.bin_width!r}|{mass_bin}|{float(mass_error)!r}{error_unit}|{lower}|{upper}"
+
+    def bin_query(self, mass, mass_error, error_unit='ppm'):
+        '''Center mass and error window in Da covering the exact error window of every mass in the bin of mass.'''
+        bin_start = np.floor(mass / self.bin_width) * self.bin_width
+        bin_end = bin_start + self.bin_width
+        largest_error = bin_end * mass_error * 0.000001 if error_unit == 'ppm' else float(mass_error)
+        return bin_start + self.bin_width / 2, self.bin_width / 2 + largest_error + 1e-6
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            return entry
+        if self.connection is not None:
+            row = self.connection.execute("SELECT counts, exact_mass FROM decompositions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = (np.frombuffer(row[0], dtype=np.int64).reshape(-1, len(self.decomposer.elements)), np.frombuffer(row[1], dtype=np.float64))
+                self._remember(key, entry)
+        return entry
+
+    def put(self, key, counts, exact_mass, commit=True):
+        entry = (np.ascontiguousarray(counts, dtype=np.int64), np.ascontiguousarray(exact_mass, dtype=np.float64))
+        self._remember(key, entry)
+        if self.connection is not None:
+            self.connection.execute("INSERT OR REPLACE INTO decompositions VALUES (?, ?, ?)", (key, entry[0].tobytes(), entry[1].tobytes()))
+            if commit:
+                self.connection.commit()
+
+    def _remember(self, key, entry):
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_bytes -= previous[0].nbytes + previous[1].nbytes
+        self.memory[key] = entry
+        self.memory_bytes += entry[0].nbytes + entry[1].nbytes
+        while self.memory_bytes > self.max_memory_bytes and self.memory: # oldest first, an entry larger than the cap is not kept
+            _, (counts, exact_mass) = self.memory.popitem(last=False)
+            self.memory_bytes -= counts.nbytes + exact_mass.nbytes
+
+    def filter_entry(self, entry, mass, mass_error, error_unit='ppm'):
+        '''Decompositions of an entry within the exact error window of mass (same test as MassDecomposer.decompose_counts).'''
+        counts, exact_mass = entry
+        mass = float(mass)
+        allowed_error = mass * mass_error * 0.000001 if error_unit == 'ppm' else float(mass_error)
+        within_error = np.abs(exact_mass - mass) <= allowed_error
+        return counts[within_error], exact_mass[within_error]
+
+    def decompose_counts(self, mass, lower_bounds=None, upper_bounds=None, mass_error=5, error_unit='ppm'):
+        '''Cached MassDecomposer.decompose_counts for a single query.'''
+        lower = self.decomposer._bounds_vector(lower_bounds, 0)
+        upper = self.decomposer._bounds_vector(upper_bounds, -1)
+        key = self.key(mass, lower, upper, mass_error, error_unit)
+        entry = self.get(key)
+        if entry is None:
+            self.misses += 1
+            center_mass, bin_error = self.bin_query(mass, mass_error, error_unit)
+            entry = self.decomposer.decompose_counts(center_mass, lower, upper, bin_error, 'Da')
+            self.put(key, *entry)
+        else:
+            self.hits += 1
+        return self.filter_entry(entry, mass, mass_error, error_unit)
+
+    def flush(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+
+def _run_decompositions(decomposer, masses, lower_bounds, upper_bounds, mass_errors, error_unit, n_workers, chunks_per_worker):
+    # decomposes the queries over the worker pool, returns the EIC positions, count matrix and exact masses ordered by query
+    n_elements = len(decomposer.elements)
+
+    # cost grows with the number of solved element counts to search and with how crowded the table is at that mass
+    solved_range = np.maximum(upper_bounds[:, decomposer.solved] - lower_bounds[:, decomposer.solved] + 1, 1)
+    estimated_cost = solved_range * (1 + masses / 1000) ** 3
+    order = np.argsort(-estimated_cost, kind='stable')
+
+    n_chunks = max(1, min(len(masses), n_workers * chunks_per_worker))
+    cumulative_cost = np.cumsum(estimated_cost[order])
+    chunk_ends = np.searchsorted(cumulative_cost, cumulative_cost[-1] * np.arange(1, n_chunks) / n_chunks) if len(masses) else []
+    chunks = [chunk for chunk in np.split(order, np.unique(chunk_ends)) if len(chunk)]
+
+    chunk_args = [(chunk, masses[chunk], lower_bounds[chunk], upper_bounds[chunk], mass_errors[chunk], error_unit) for chunk in chunks]
+    if n_workers <= 1 or len(chunks) <= 1:
+        _init_decomposition_worker(decomposer)
+        results = [_decompose_chunk(*args) for args in chunk_args]
+    else:
+        if 'fork' in multiprocessing.get_all_start_methods(): # fork shares the lookup table instead of pickling it to every worker
+            mp_context = multiprocessing.get_context('fork')
+        else:
+            mp_context = multiprocessing.get_context()
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context, 
+                                 initializer=_init_decomposition_worker, initargs=(decomposer,)) as executor:
+            results = list(executor.map(_decompose_chunk, *zip(*chunk_args)))
+
+    if not results:
+        return np.empty(0, dtype=np.int64), np.empty((0, n_elements), dtype=np.int64), np.empty(0)
+    query_index = np.concatenate([np.repeat(query_positions, decomposition_counts) for query_positions, decomposition_counts, _, _ in results])
+    counts = np.concatenate([counts for _, _, counts, _ in results])
+    exact_mass = np.concatenate([exact_mass for _, _, _, exact_mass in results])
+
+    order = np.argsort(query_index, kind='stable') # chunks come back in cost order, decompositions of one query stay in order
+    return query_index[order], counts[order], exact_mass[order]
+
+
+def decompose_batch(iso_pattern_df_grouped, decomposer, mass_error, error_unit='ppm', mass_column='wmean_mz',
+                    lower_columns=None, upper_columns=None, n_workers=1, chunks_per_worker=8, cache=None):
+    '''
+    Decompose every row (EIC) of the grouped element range table.
+
+    The decomposer (and its lookup table) is given to every worker once when the pool starts, with fork it is shared
+    copy-on-write. High-mass EICs have much larger element ranges, so the queries are ordered by estimated cost
+    (largest first) and cut into chunks of about equal total cost, chunks_per_worker per worker.
+
+    lower_columns, upper_columns: {element: column}, by default {element}minpred_995_min and {element}maxpred_995_max.
+    cache: optional DecompositionCache, only the mass bins missing from it are decomposed (once per bin, even if
+    several EICs share it), the rest is filtered out of the cached entries.
+
+    Return
+    ======
+        columnar DataFrame with one row per decomposition: 'EIC_index' (row position in iso_pattern_df_grouped),
+        one column of counts per element, 'formula', 'exact_mass' and 'ppm_error', ordered by EIC_index.
+    '''
+    elements = decomposer.elements
+    if lower_columns is None:
+        lower_columns = {element: f'{element}minpred_995_min' for element in elements}
+    if upper_columns is None:
+        upper_columns = {element: f'{element}maxpred_995_max' for element in elements}
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    masses = iso_pattern_df_grouped[mass_column].to_numpy(dtype=np.float64)
+    lower_bounds = np.column_stack([iso_pattern_df_grouped[lower_columns[element]].astype(int).to_numpy() if element in lower_columns 
+                                    else np.zeros(len(masses), dtype=np.int64) for element in elements]).reshape(len(masses), len(elements))
+    upper_bounds = np.column_stack([iso_pattern_df_grouped[upper_columns[element]].astype(int).to_numpy() if element in upper_columns 
+                                    else np.full(len(masses), -1, dtype=np.int64) for element in elements]).reshape(len(masses), len(elements))
+
+    if cache is None:
+        eic_index, counts, exact_mass = _run_decompositions(decomposer, masses, lower_bounds, upper_bounds, np.full(len(masses), float(mass_error)), 
+                                                            error_unit, n_workers, chunks_per_worker)
+    else:
+        keys = [cache.key(masses[i], lower_bounds[i], upper_bounds[i], mass_error, error_unit) for i in range(len(masses))]
+        entries = {}
+        missing = {} # key -> first EIC in that bin
+        for i, key in enumerate(keys):
+            if key in entries or key in missing:
+                continue
+            entry = cache.get(key)
+            if entry is None:
+                missing[key] = i
+            else:
+                entries[key] = entry
+        cache.hits += len(keys) - len(missing)
+        cache.misses += len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            first_eics = np.array(list(missing.values()), dtype=np.int64)
+            bin_queries = np.array([cache.bin_query(masses[i], mass_error, error_unit) for i in first_eics]).reshape(-1, 2)
+            query_index, bin_counts, bin_exact_mass = _run_decompositions(decomposer, bin_queries[:, 0], lower_bounds[first_eics], upper_bounds[first_eics], 
+                                                                          bin_queries[:, 1], 'Da', n_workers, chunks_per_worker)
+            bin_starts = np.searchsorted(query_index, np.arange(len(missing_keys) + 1))
+            for j, key in enumerate(missing_keys):
+                entries[key] = (bin_counts[bin_starts[j]:bin_starts[j + 1]], bin_exact_mass[bin_starts[j]:bin_starts[j + 1]])
+                cache.put(key, *entries[key], commit=False)
+            cache.flush()
+
+        results = [cache.filter_entry(entries[key], masses[i], mass_error, error_unit) for i, key in enumerate(keys)]
+        eic_index = np.repeat(np.arange(len(masses)), [len(query_counts) for query_counts, _ in results]).astype(np.int64)
+        counts = np.concatenate([query_counts for query_counts, _ in results]) if results else np.empty((0, len(elements)), dtype=np.int64)
+        exact_mass = np.concatenate([query_exact_mass for _, query_exact_mass in results]) if results else np.empty(0)
+
+    decompositions = pd.DataFrame(counts, columns=elements)
+    decompositions.insert(0, 'EIC_index', eic_index)
+    decompositions['formula'] = decomposer.formula_strings(counts)
+    decompositions['exact_mass'] = exact_mass
+    decompositions['ppm_error'] = (exact_mass - masses[eic_index]) / masses[eic_index] * 1e6
+    return decompositions
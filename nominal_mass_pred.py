@@ -1,8 +1,5 @@
 import pandas as pd
-from sklearn.linear_model import LinearRegression
 import numpy as np
-from sklearn.metrics import mean_squared_error
-from sklearn.preprocessing import PolynomialFeatures
 
 k = 1.96
 MSE = 0.029188325596117455
@@ -28,8 +25,12 @@ def PredNomMass(monoMass, k, MSE, corr_fact, diff_mass_sum):
 
 
 
-# Calculated using this :
+# Calculated using this (sklearn is only needed for this, not imported when the pipeline runs):
 '''
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_squared_error
+from sklearn.preprocessing import PolynomialFeatures
+
 df = pd.read_csv('database_folder/Lipid_Maps_and_SWISS_lipids.csv')
 X = df['mass1'].values.reshape(-1, 1)
 y = df['nominal_mass'].values
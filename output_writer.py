@@ -0,0 +1,47 @@
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncOutputWriter:
+    '''
+    Writes the trackable outputs in a background thread so the pipeline does not wait on the disk.
+    The outputs are only written for inspection, the stages hand their results over in memory.
+    DataFrames are copied when they are submitted, later changes to them do not end up in the file.
+    '''
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+
+    def _submit(self, function, *args, **kwargs):
+        self._futures.append(self._executor.submit(function, *args, **kwargs))
+
+    def to_csv(self, df, path, **kwargs):
+        self._submit(df.copy().to_csv, path, **kwargs)
+
+    def pickle(self, obj, path):
+        self._submit(_write_pickle, obj, path)
+
+    def wait(self):
+        '''Blocks until everything submitted is written, errors of the writes are raised here.'''
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _write_pickle(obj, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f)
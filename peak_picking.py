@@ -1,29 +1,29 @@
 import numpy as np
+import pandas as pd
 import networkx as nx
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
 
 
-def build_centurion_tree(list_peaks): #function modified from mass2chem
+def build_centurion_tree(mz): #function modified from mass2chem
     '''
-    list_peaks: [{'parent_masstrace_id': 1670, 'mz': 133.09702315984987, 'apex': 654, 'height': 14388.0, 
-                    'left_base': 648, 'right_base': 655, 'id_number': 555}, ...]
-    Return a dictionary, indexing mzList by 100*mz bins.
+    mz: m/z array of one scan (see ScanPeakArrays).
+    Return a dictionary, indexing positions in mz by 100*mz bins.
     Because most high-resolution mass spectrometers measure well under 0.01 amu, 
     one only needs to search the corresponding 0.01 bin and two adjacent bins (to capture bordering values).
-    list_mass_tracks has similar format as list_peaks.
     '''
-    d = {}
-    for p in list_peaks:
-        cent = int(100 * p['mz'])
-        if cent in d:
-            d[cent].append(p)
-        else:
-            d[cent] = [p]
-    return d
+    cents = (100 * mz).astype(np.int64)
+    order = np.argsort(cents, kind='stable') # stable so peaks keep their scan order within a bin
+    unique_cents, starts = np.unique(cents[order], return_index=True)
+    return dict(zip(unique_cents.tolist(), np.split(order, starts[1:])))
 
 
-def find_all_matches_centurion_indexed_list(query_mz, mz_centurion_tree, limit_ppm): # function modified from mass2chem
+def find_all_matches_centurion_indexed_list(query_mz, mz_centurion_tree, limit_ppm, mz): # function modified from mass2chem
     '''
-    Return matched peaks in mz_centurion_tree by m/z diff within limit_ppm.
+    Return positions of matched peaks in mz_centurion_tree by m/z diff within limit_ppm.
     '''
     q = int(query_mz * 100) 
 
@@ -32,7 +32,7 @@ def find_all_matches_centurion_indexed_list(query_mz, mz_centurion_tree, limit_p
     for ii in (q-2, q-1, q, q+1, q+2): #changed from +/- 1  to +/- 2 as for higher mass values +1 is less than 5ppm
         L = mz_centurion_tree.get(ii, [])
         for peak in L:
-            diff = peak['mz'] - query_mz
+            diff = mz[peak] - query_mz
             if - mz_tol < diff < mz_tol: # not looking for the halogen small mass diffs yet
 
                 results.append(peak)
@@ -40,9 +40,9 @@ def find_all_matches_centurion_indexed_list(query_mz, mz_centurion_tree, limit_p
     return results
 
 
-def find_all_matches_centurion_indexed_list_for_m32(query_mz, mz_centurion_tree, limit_ppm):
+def find_all_matches_centurion_indexed_list_for_m32(query_mz, mz_centurion_tree, limit_ppm, mz):
     '''
-    Return matched peaks in mz_centurion_tree by m/z diff within limit_ppm.
+    Return positions of matched peaks in mz_centurion_tree by m/z diff within limit_ppm.
     '''
     q = int(query_mz * 100) 
 
@@ -54,33 +54,62 @@ def find_all_matches_centurion_indexed_list_for_m32(query_mz, mz_centurion_tree,
         L = mz_centurion_tree.get(ii, [])
         for peak in L:
             if query_mz < 1000:
-                diff = peak['mz'] - query_mz
+                diff = mz[peak] - query_mz
                 if mz_tol < diff < mz_tol: 
-                    if peak['mz'] - second_peak_mz > 0.992:
+                    if mz[peak] - second_peak_mz > 0.992:
                         results.append(peak)
-            elif query_mz > 1000 and abs(peak['mz'] - query_mz) < mz_tol:
+            elif query_mz > 1000 and abs(mz[peak] - query_mz) < mz_tol:
                     results.append(peak)
     return results
 
 
-#to generate lists directy from mzml file, for each rt spectrum
-def generate_peak_lists_for_all_rt(exp):
-    all_peak_lists = []
-    for spectrum_index, spectrum in enumerate(exp):
-        peak_list = []
-        rt = spectrum.getRT()
-        peaks = spectrum.get_peaks()
-        for peak_id, (mz, intensity) in enumerate(zip(*peaks)):
-            if intensity > 0: 
-                peak_dict = {
-                    'mz': mz,
-                    'rtime': rt,
-                    'height': intensity,
-                    'id': f"{peak_id}",
-                }
-                peak_list.append(peak_dict)
-        all_peak_lists.append(peak_list)
-    return all_peak_lists
+# columnar store of all centroids in a run, used instead of one dict per peak
+class ScanPeakArrays:
+    '''
+    All centroids of a run kept in two flat arrays with scan offsets,
+    scan i is mz[offsets[i]:offsets[i+1]] and intensity[offsets[i]:offsets[i+1]].
+    Iterating gives (rt, mz, intensity) per scan, the arrays being views (no copies).
+    '''
+    def __init__(self, rts, mz, intensity, offsets):
+        self.rts = rts
+        self.mz = mz
+        self.intensity = intensity
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.rts)
+
+    def scan(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return float(self.rts[i]), self.mz[start:end], self.intensity[start:end]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.scan(i)
+
+    def __repr__(self):
+        return f"ScanPeakArrays(scans={len(self)}, peaks={len(self.mz)})"
+
+
+#to generate arrays directy from mzml file, for each rt spectrum
+def generate_scan_arrays_for_all_rt(exp):
+    rts = []
+    mz_arrays = []
+    intensity_arrays = []
+    for spectrum in exp:
+        mz, intensity = spectrum.get_peaks()
+        keep = intensity > 0 # zero intensity centroids are removed
+        rts.append(spectrum.getRT())
+        mz_arrays.append(mz[keep])
+        intensity_arrays.append(intensity[keep])
+
+    offsets = np.zeros(len(rts) + 1, dtype=np.int64)
+    np.cumsum([len(mz) for mz in mz_arrays], out=offsets[1:])
+
+    if not rts:
+        return ScanPeakArrays(np.empty(0), np.empty(0), np.empty(0, dtype=np.float32), offsets)
+
+    return ScanPeakArrays(np.asarray(rts, dtype=np.float64), np.concatenate(mz_arrays), np.concatenate(intensity_arrays), offsets)
 
 
 def within_tolerance(value1, value2, target_difference, ppm_tolerance):
@@ -90,8 +119,60 @@ def within_tolerance(value1, value2, target_difference, ppm_tolerance):
             return abs(difference - target_difference) <= tolerance
 
 
-def get_isotopic_edge_pairs(list_peaks,  # function modified from kiphu
-                    mztree, 
+def find_isotopic_edges_sorted(mz, mz_tolerance_ppm, 
+                    search_patterns = [(1.003355, '13C/12C', (0.1, 0.8))],
+                    ):
+    '''
+    Batched isotope edge search over all peaks of one scan.
+
+    For every peak i and every search pattern, all peaks j with |mz_j - (mz_i + mass difference)| < ppm tolerance
+    are found with np.searchsorted windows on the sorted m/z array, all patterns in one pass.
+    The tolerance test is the same as in find_all_matches_centurion_indexed_list.
+
+    Return
+    ======
+        arrays (i, j, pattern index) of positions in mz, ordered by i, then search pattern, then m/z of j
+        (the order get_isotopic_edge_pairs used to produce them in).
+    '''
+    n = len(mz)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    order = None
+    if np.any(mz[1:] < mz[:-1]): # centroided scans are normally already sorted
+        order = np.argsort(mz, kind='stable')
+        mz = mz[order]
+
+    mass_differences = np.array([_pair[0] for _pair in search_patterns], dtype=np.float64)
+    targets = (mz[None, :] + mass_differences[:, None]).ravel() # one row per search pattern
+    mz_tol = targets * mz_tolerance_ppm * 0.000001
+
+    # windows slightly wider than the tolerance, the exact (strict) test is done afterwards
+    lower = np.searchsorted(mz, targets - 1.01 * mz_tol, side='left')
+    upper = np.searchsorted(mz, targets + 1.01 * mz_tol, side='right')
+    counts = upper - lower
+
+    query = np.repeat(np.arange(len(targets)), counts)
+    window_starts = np.repeat(lower - (np.cumsum(counts) - counts), counts)
+    j = np.arange(len(query)) + window_starts
+
+    diff = mz[j] - targets[query]
+    keep = (-mz_tol[query] < diff) & (diff < mz_tol[query])
+    query = query[keep]
+    j = j[keep]
+    pattern, i = np.divmod(query, n)
+
+    j_sorted = j
+    if order is not None: # back to positions in the unsorted scan
+        i = order[i]
+        j = order[j]
+
+    edge_order = np.lexsort((j_sorted, pattern, i))
+    return i[edge_order], j[edge_order], pattern[edge_order]
+
+
+def get_isotopic_edge_pairs(mz, intensity,  # function modified from kiphu
                     mz_tolerance_ppm, 
                     search_patterns = [(1.003355, '13C/12C', (0.1, 0.8))], # (0.1, 0.8) is to do with checking relative abundances but this will not be used here
                     check_isotope_ratio = False, # not checking abundances FALSE
@@ -101,10 +182,8 @@ def get_isotopic_edge_pairs(list_peaks,  # function modified from kiphu
 
     Input
     =====
-    list_peaks: 
-        [{'parent_masstrace_id': 1670, 'mz': 133.09702315984987, 'rtime': 654, 'height': 14388.0, 'id': 555}, ...]
-    mztree: 
-        indexed list_peaks
+    mz, intensity: 
+        m/z and intensity arrays of one scan, as given by ScanPeakArrays.
     mz_tolerance_ppm: 
         ppm tolerance in examining m/z patterns.
     search_patterns: 
@@ -122,22 +201,18 @@ def get_isotopic_edge_pairs(list_peaks,  # function modified from kiphu
         list of lists of peak pairs that match search_patterns patterns, 
         e.g.[ (195, 206, '13C/12C'), ...]. 
     '''
-    signatures = []
-    for P1 in list_peaks:
-        matched = [  ] 
-        for _pair in search_patterns:
-            (mass_difference, _) = _pair[:2]
-            tmp = find_all_matches_centurion_indexed_list(P1['mz'] + mass_difference, mztree, mz_tolerance_ppm)
-            for P2 in tmp:
-                if check_isotope_ratio and len(_pair) > 2:  # checking abundance ratio
-                    (abundance_ratio_min, abundance_ratio_max) = _pair[2]
-                    if abundance_ratio_min*P1['height'] < P2['height'] < abundance_ratio_max*P1['height']:
-                        matched.append( (P1['id'], P2['id'], P1['height'], P2['height']) )
-                else:
-                    matched.append( (P1['mz'], P2['mz'], P1['height'], P2['height']) )
-        signatures += matched
-    
-    return signatures
+    P1, P2, pattern = find_isotopic_edges_sorted(mz, mz_tolerance_ppm, search_patterns)
+
+    if check_isotope_ratio:  # checking abundance ratio, for the patterns that have one
+        ratio_min = np.array([_pair[2][0] if len(_pair) > 2 else -np.inf for _pair in search_patterns])[pattern]
+        ratio_max = np.array([_pair[2][1] if len(_pair) > 2 else np.inf for _pair in search_patterns])[pattern]
+        with_ratio = np.array([len(_pair) > 2 for _pair in search_patterns], dtype=bool)[pattern]
+        keep = ~with_ratio | ((ratio_min*intensity[P1] < intensity[P2]) & (intensity[P2] < ratio_max*intensity[P1]))
+        # positions in the scan arrays for pairs with a checked ratio, as the ids were before
+        return [(p1, p2, intensity[p1], intensity[p2]) if checked else (mz[p1], mz[p2], intensity[p1], intensity[p2])
+                for p1, p2, checked in zip(P1[keep], P2[keep], with_ratio[keep])]
+
+    return list(zip(mz[P1], mz[P2], intensity[P1], intensity[P2]))
 
 
 def filter_chains(subnetwork_chain_list): #input is a list of lists and each inner list has all the chains from a subnetwork
@@ -235,11 +310,15 @@ def find_paths_from_sources_to_sinks(G):
 
 
 
-def peaks_to_networks_to_chains(peak_list,  mz_tolerance_ppm, # heavily modified from kiphu
+def peaks_to_networks_to_chains_networkx(mz, intensity,  mz_tolerance_ppm, # heavily modified from kiphu
             isotope_search_patterns = [ (1.003355, '13C/12C', (0, 0.8))]
                     ):
-    mztree = build_centurion_tree(peak_list)
-    iso_edges = get_isotopic_edge_pairs(peak_list, mztree, mz_tolerance_ppm=mz_tolerance_ppm,
+    '''
+    Original networkx version of peaks_to_networks_to_chains, enumerating all source to sink paths.
+    Kept for the m32 option below and to check extract_triples_from_edges against, it is exponential on dense clusters.
+    '''
+    mztree = build_centurion_tree(mz) # only used for the m32 search below
+    iso_edges = get_isotopic_edge_pairs(mz, intensity, mz_tolerance_ppm=mz_tolerance_ppm,
                                         search_patterns=isotope_search_patterns,
                                         check_isotope_ratio=False,
                                         )
@@ -271,15 +350,15 @@ def peaks_to_networks_to_chains(peak_list,  mz_tolerance_ppm, # heavily modified
             #print('chain', chain)
             P2_mass = chain[1][0] #[second peak][mass of peak]
             mass_difference = 1.003355
-            tmp = find_all_matches_centurion_indexed_list_for_m32(P2_mass + mass_difference, mztree, mz_tolerance_ppm) 
+            tmp = find_all_matches_centurion_indexed_list_for_m32(P2_mass + mass_difference, mztree, mz_tolerance_ppm, mz) 
 
             for P3 in tmp: # IF tmp IS EMPTY THEN THIS PART IS NOT DONE HENCE ALL CHAINS OF LENGTH < 3 ARE REMOVED
                 #print('This is P3:', P3)
-                new_chain = chain 
+                new_chain = chain.copy() # copy, assigning the third peak below used to overwrite the chain itself
                 if len(new_chain) < 3:  # If there's no third row in the chain array
-                    new_chain = np.vstack([new_chain, [P3['mz'], P3['height']]])  # Append a new row with P3 values
+                    new_chain = np.vstack([new_chain, [mz[P3], intensity[P3]]])  # Append a new row with P3 values
                 else:
-                    new_chain[2] = [P3['mz'], P3['height']]  # Update the existing third peak with P3 values
+                    new_chain[2] = [mz[P3], intensity[P3]]  # Update the existing third peak with P3 values
 
                 #print('new chain', new_chain)
                 new_subnetwork_chains.append(new_chain)
@@ -305,6 +384,264 @@ def peaks_to_networks_to_chains(peak_list,  mz_tolerance_ppm, # heavily modified
     return filtered_subnetwork_chains
 
 
+def extract_triples_from_edges(P1, P2, mz, intensity):
+    '''
+    Isotope triples straight from the edge arrays of one scan (from find_isotopic_edges_sorted),
+    without building the networkx graph or enumerating every source to sink path.
+
+    Gives exactly the triples filter_chains keeps from find_paths_from_sources_to_sinks:
+    a path is trimmed while its first peak is < 0.1 of the next one and only its first three peaks are kept,
+    so a triple (a, b, c) is kept when
+        - a is a source (no incoming edge) or is reached from a source through such 'small' steps only,
+        - a -> b is not a small step and b -> c is an edge,
+        - the three intensities sum to at least 1000.
+    The 'reached' flags are propagated in at most (longest run of small steps) vectorized passes and the triples
+    come from joining edges on b, so the worst case is the number of (a -> b, b -> c) edge pairs, not the number of paths.
+
+    Return
+    ======
+        (n, 3) array of peak positions in the scan, ordered by a, then b, then c.
+    '''
+    intensity = intensity.astype(np.float64) # same precision the chain arrays were compared in
+
+    # edges point from lower to higher m/z, as in the networkx graph, and duplicates are dropped
+    src = np.where(mz[P1] < mz[P2], P1, P2)
+    dst = np.where(mz[P1] < mz[P2], P2, P1)
+    edges = np.unique(np.column_stack((src, dst)).astype(np.int64), axis=0).reshape(-1, 2)
+    src, dst = edges[:, 0], edges[:, 1]
+
+    n_peaks = len(mz)
+    has_in_edge = np.zeros(n_peaks, dtype=bool)
+    has_in_edge[dst] = True
+    reached = np.zeros(n_peaks, dtype=bool)
+    reached[src] = ~has_in_edge[src] # sources of the graph
+
+    small_step = intensity[src] < 0.1*intensity[dst] # first peak removed by filter_chains
+    while True:
+        newly_reached = dst[small_step & reached[src] & ~reached[dst]]
+        if newly_reached.size == 0:
+            break
+        reached[newly_reached] = True
+
+    first = np.flatnonzero(reached[src] & ~small_step) # a -> b edges that can start a triple
+    second_start = np.searchsorted(src, dst[first], side='left') # b -> c edges, src is sorted
+    second_end = np.searchsorted(src, dst[first], side='right')
+    counts = second_end - second_start
+
+    first = np.repeat(first, counts)
+    second = np.arange(len(first)) + np.repeat(second_start - (np.cumsum(counts) - counts), counts)
+    triples = np.column_stack((src[first], dst[first], dst[second])).reshape(-1, 3)
+
+    triple_total_intensity = intensity[triples[:, 0]] + intensity[triples[:, 1]] + intensity[triples[:, 2]]
+    return triples[triple_total_intensity >= 1000] # getting rid of patterns where the three intensities sum to <1000
+
+
+def peaks_to_networks_to_chains(mz, intensity,  mz_tolerance_ppm, 
+            isotope_search_patterns = [ (1.003355, '13C/12C', (0, 0.8))]
+                    ):
+    '''
+    Mine the isotope triples of one scan.
+    Returns a list of 3x2 arrays [[m/z, intensity], ...] (first three peaks of each isotope chain),
+    the same triples as peaks_to_networks_to_chains_networkx without the m32 option.
+    '''
+    P1, P2, _ = find_isotopic_edges_sorted(mz, mz_tolerance_ppm, isotope_search_patterns)
+    triples = extract_triples_from_edges(P1, P2, mz, intensity)
+
+    chains = np.stack((mz[triples], intensity[triples].astype(np.float64)), axis=-1)
+    return list(chains)
+
+
+def _mine_triples_chunk(rts, mz, intensity, offsets, mz_tolerance_ppm, isotope_search_patterns):
+    # runs in a worker: mines a contiguous block of scans and sends the triples back as one (n, 3, 2) array
+    triple_counts = np.zeros(len(rts), dtype=np.int64)
+    chains = []
+    for i in range(len(rts)):
+        scan_mz = mz[offsets[i]:offsets[i + 1]]
+        if scan_mz.size:
+            scan_chains = peaks_to_networks_to_chains(scan_mz, intensity[offsets[i]:offsets[i + 1]], mz_tolerance_ppm, isotope_search_patterns)
+            triple_counts[i] = len(scan_chains)
+            chains.extend(scan_chains)
+    chains = np.array(chains, dtype=np.float64).reshape(-1, 3, 2)
+    return triple_counts, chains
+
+
+def mine_triples(scan_arrays, mz_tolerance_ppm, 
+            isotope_search_patterns = [ (1.003355, '13C/12C', (0, 0.8))],
+            n_workers = 1,
+            scans_per_chunk = 64,
+                    ):
+    '''
+    Mine the isotope triples of all scans in a ScanPeakArrays.
+
+    With n_workers > 1 (None for all cores) blocks of scans_per_chunk consecutive scans are sent to a process pool,
+    each block being one slice of the flat m/z and intensity arrays, and the results are put back in scan order.
+
+    Return
+    ======
+        all_triples_dictionary: {rt: [3x2 array [[m/z, intensity], ...], ...]} for every scan with peaks,
+        the same dictionary (and order) for any number of workers.
+    '''
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    all_triples_dictionary = {}
+    if n_workers <= 1:
+        for rt, mz, intensity in tqdm(scan_arrays, desc="Mining Triples...", unit="scan"):
+            if mz.size:
+                arrays_of_triples = peaks_to_networks_to_chains(mz, intensity, mz_tolerance_ppm, isotope_search_patterns)
+                all_triples_dictionary[rt] = [array for array in arrays_of_triples if array.size > 0]
+        return all_triples_dictionary
+
+    chunk_starts = range(0, len(scan_arrays), scans_per_chunk)
+    chunks = []
+    for start in chunk_starts:
+        end = min(start + scans_per_chunk, len(scan_arrays))
+        first_peak, last_peak = scan_arrays.offsets[start], scan_arrays.offsets[end]
+        chunks.append((scan_arrays.rts[start:end], scan_arrays.mz[first_peak:last_peak], scan_arrays.intensity[first_peak:last_peak], 
+                       scan_arrays.offsets[start:end + 1] - first_peak))
+
+    # fork where available so workers do not re-import (and re-run) the calling script
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = multiprocessing.get_context()
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as executor:
+        results = executor.map(_mine_triples_chunk, *zip(*chunks), [mz_tolerance_ppm]*len(chunks), [isotope_search_patterns]*len(chunks))
+        for (rts, mz, _, offsets), (triple_counts, chains) in tqdm(zip(chunks, results), total=len(chunks), desc="Mining Triples...", unit="chunk"):
+            _add_chunk_triples(all_triples_dictionary, rts, offsets, triple_counts, chains)
+
+    return all_triples_dictionary
+
+
+def _add_chunk_triples(all_triples_dictionary, rts, offsets, triple_counts, chains):
+    # puts the triples of a mined block of scans back per rt
+    triple_ends = np.cumsum(triple_counts)
+    for i in range(len(rts)):
+        if offsets[i + 1] > offsets[i]: # scans without peaks are skipped as in the serial loop
+            all_triples_dictionary[float(rts[i])] = list(chains[triple_ends[i] - triple_counts[i]:triple_ends[i]])
+
+
+def raw_file_handler(raw_file_path):
+    '''pyopenms MzMLFile or MzXMLFile for the extension of raw_file_path.'''
+    from pyopenms import MzMLFile, MzXMLFile
+    extension = os.path.splitext(raw_file_path)[1].lower()
+    if extension == '.mzml':
+        return MzMLFile()
+    if extension == '.mzxml':
+        return MzXMLFile()
+    raise ValueError(f"Unknown raw file type {raw_file_path}, use .mzML or .mzXML")
+
+
+def load_raw_file(raw_file_path):
+    '''The whole .mzML or .mzXML file as an MSExperiment.'''
+    from pyopenms import MSExperiment
+    exp = MSExperiment()
+    raw_file_handler(raw_file_path).load(raw_file_path, exp)
+    return exp
+
+
+class StreamingTripleMiner:
+    '''
+    Spectrum consumer for pyopenms MzMLFile().transform / MzXMLFile().transform: the triples are mined while
+    the file is read, spectrum by spectrum, instead of loading the whole MSExperiment first.
+
+    Spectra are buffered in blocks of scans_per_chunk and every block is mined as in mine_triples (on a process
+    pool for n_workers > 1, with at most 2 * n_workers blocks in flight). Only the triple arrays are kept,
+    so memory is bounded by a few blocks of spectra whatever the length of the file.
+    finish() returns the same dictionary as mine_triples on the loaded file.
+    '''
+    def __init__(self, mz_tolerance_ppm, isotope_search_patterns=[(1.003355, '13C/12C', (0, 0.8))], n_workers=1, scans_per_chunk=64):
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        self.mz_tolerance_ppm = mz_tolerance_ppm
+        self.isotope_search_patterns = isotope_search_patterns
+        self.n_workers = n_workers
+        self.scans_per_chunk = scans_per_chunk
+        self.all_triples_dictionary = {}
+        self.n_spectra = 0
+        self._rts, self._mz, self._intensity = [], [], []
+        self._pending = deque()
+        self._executor = None
+        if n_workers > 1:
+            if 'fork' in multiprocessing.get_all_start_methods(): # fork so workers do not re-import (and re-run) the calling script
+                mp_context = multiprocessing.get_context('fork')
+            else:
+                mp_context = multiprocessing.get_context()
+            self._executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context)
+
+    def __repr__(self):
+        return f"StreamingTripleMiner(spectra={self.n_spectra}, scans with triples={len(self.all_triples_dictionary)})"
+
+    # pyopenms consumer interface
+    def setExpectedSize(self, n_spectra, n_chromatograms):
+        pass
+
+    def setExperimentalSettings(self, settings):
+        pass
+
+    def consumeChromatogram(self, chromatogram):
+        pass
+
+    def consumeSpectrum(self, spectrum):
+        mz, intensity = spectrum.get_peaks()
+        keep = intensity > 0 # zero intensity centroids are removed
+        self._rts.append(spectrum.getRT())
+        self._mz.append(mz[keep])
+        self._intensity.append(intensity[keep])
+        self.n_spectra += 1
+        if len(self._rts) >= self.scans_per_chunk:
+            self._submit_block()
+
+    def _submit_block(self):
+        offsets = np.zeros(len(self._rts) + 1, dtype=np.int64)
+        np.cumsum([len(mz) for mz in self._mz], out=offsets[1:])
+        block = (np.asarray(self._rts, dtype=np.float64), np.concatenate(self._mz) if self._mz else np.empty(0), 
+                 np.concatenate(self._intensity) if self._intensity else np.empty(0, dtype=np.float32), offsets)
+        self._rts, self._mz, self._intensity = [], [], []
+
+        if self._executor is None:
+            triple_counts, chains = _mine_triples_chunk(*block, self.mz_tolerance_ppm, self.isotope_search_patterns)
+            _add_chunk_triples(self.all_triples_dictionary, block[0], offsets, triple_counts, chains)
+            return
+        self._pending.append((block[0], offsets, self._executor.submit(_mine_triples_chunk, *block, self.mz_tolerance_ppm, self.isotope_search_patterns)))
+        while len(self._pending) > 2 * self.n_workers: # blocks are collected in file order
+            self._collect_oldest()
+
+    def _collect_oldest(self):
+        rts, offsets, future = self._pending.popleft()
+        triple_counts, chains = future.result()
+        _add_chunk_triples(self.all_triples_dictionary, rts, offsets, triple_counts, chains)
+
+    def finish(self):
+        if self._rts:
+            self._submit_block()
+        while self._pending:
+            self._collect_oldest()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return self.all_triples_dictionary
+
+
+def mine_triples_streaming(raw_file_path, mz_tolerance_ppm, 
+            isotope_search_patterns = [ (1.003355, '13C/12C', (0, 0.8))],
+            n_workers = 1,
+            scans_per_chunk = 64,
+                    ):
+    '''
+    mine_triples reading the .mzML / .mzXML file spectrum by spectrum (StreamingTripleMiner), with bounded memory.
+
+    Return
+    ======
+        all_triples_dictionary: {rt: [3x2 array [[m/z, intensity], ...], ...]}, as mine_triples
+    '''
+    consumer = StreamingTripleMiner(mz_tolerance_ppm, isotope_search_patterns, n_workers, scans_per_chunk)
+    print('Mining Triples while reading', raw_file_path, '...')
+    raw_file_handler(raw_file_path).transform(raw_file_path, consumer)
+    return consumer.finish()
+
+
 
 
 
@@ -333,6 +670,115 @@ class Peak:
         return f"Peak(rt={self.rt}, rt_min={self.rt_min}, rt_max={self.rt_max}, mz_min={self.mz_min}, mz_max={self.mz_max}, mz={self.mz}, id={self.id})"
 
 
+# used to check all triples against the centwave peaks at once instead of with is_in_peak
+class EICIntervalIndex:
+    '''
+    (rt, mz) boxes of the centWave peaks for batched is_in_peak lookups.
+
+    The boxes are sorted by mz_min, so the candidates for a query m/z are the boxes with
+    mz - (largest mz width) <= mz_min <= mz, found with two np.searchsorted calls.
+    Boxes are split in tiers of similar mz width (a factor 2 apart) so a few wide boxes do not widen every window.
+    '''
+    def __init__(self, rt_min, rt_max, mz_min, mz_max):
+        self.rt_min = np.asarray(rt_min, dtype=np.float64)
+        self.rt_max = np.asarray(rt_max, dtype=np.float64)
+        self.mz_min = np.asarray(mz_min, dtype=np.float64)
+        self.mz_max = np.asarray(mz_max, dtype=np.float64)
+
+        valid = np.isfinite(self.rt_min) & np.isfinite(self.rt_max) & np.isfinite(self.mz_min) & np.isfinite(self.mz_max) # rows that could not be read never match
+        positions = np.flatnonzero(valid)
+        widths = self.mz_max[positions] - self.mz_min[positions]
+        width_tiers = np.ceil(np.log2(np.maximum(widths, 1e-4) / 1e-4)).astype(np.int64) # 0.1 mDa, 0.2 mDa, 0.4 mDa, ...
+
+        self.tiers = [] # (positions sorted by mz_min, sorted mz_min, largest mz width)
+        for tier in np.unique(width_tiers):
+            tier_positions = positions[width_tiers == tier]
+            tier_positions = tier_positions[np.argsort(self.mz_min[tier_positions], kind='stable')]
+            max_width = np.max(self.mz_max[tier_positions] - self.mz_min[tier_positions])
+            self.tiers.append((tier_positions, self.mz_min[tier_positions], max_width))
+
+    @classmethod
+    def from_dataframe(cls, centwave_df):
+        return cls(centwave_df['rtmin'], centwave_df['rtmax'], centwave_df['mzmin'], centwave_df['mzmax'])
+
+    def __len__(self):
+        return len(self.mz_min)
+
+    def query(self, rts, mzs):
+        '''
+        Row position of the first box (in centWave output order) containing each (rt, mz), -1 if there is none.
+        Same first match as is_in_peak with the Peak list in the same order.
+        '''
+        rts = np.asarray(rts, dtype=np.float64)
+        mzs = np.asarray(mzs, dtype=np.float64)
+        no_match = len(self.mz_min)
+        first_match = np.full(len(mzs), no_match, dtype=np.int64)
+
+        for tier_positions, tier_mz_min, max_width in self.tiers:
+            lower = np.searchsorted(tier_mz_min, mzs - 1.01 * max_width, side='left') # exact test is done below
+            upper = np.searchsorted(tier_mz_min, mzs, side='right')
+            counts = upper - lower
+
+            query = np.repeat(np.arange(len(mzs)), counts)
+            candidates = tier_positions[np.arange(len(query)) + np.repeat(lower - (np.cumsum(counts) - counts), counts)]
+
+            inside = ((self.rt_min[candidates] <= rts[query]) & (rts[query] <= self.rt_max[candidates]) 
+                      & (self.mz_min[candidates] <= mzs[query]) & (mzs[query] <= self.mz_max[candidates]))
+            np.minimum.at(first_match, query[inside], candidates[inside])
+
+        first_match[first_match == no_match] = -1
+        return first_match
+
+
+# centwave peaks (EICs) as one typed array per column, used instead of one Peak object per row
+class EICTable:
+    '''
+    Struct of arrays for the centWave output: ids (the EIC_ID, row label in centwave_output.csv),
+    mz (wMean m/z), mz_min, mz_max, rt, rt_min, rt_max.
+    Values that can not be read as numbers are NaN (such rows never contain a triple).
+    '''
+    __slots__ = ('ids', 'mz', 'mz_min', 'mz_max', 'rt', 'rt_min', 'rt_max', '_interval_index')
+
+    centwave_columns = {'mz': 'mz', 'mz_min': 'mzmin', 'mz_max': 'mzmax', 'rt': 'rt', 'rt_min': 'rtmin', 'rt_max': 'rtmax'}
+
+    def __init__(self, ids, mz, mz_min, mz_max, rt, rt_min, rt_max):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.mz_min = np.asarray(mz_min, dtype=np.float64)
+        self.mz_max = np.asarray(mz_max, dtype=np.float64)
+        self.rt = np.asarray(rt, dtype=np.float64)
+        self.rt_min = np.asarray(rt_min, dtype=np.float64)
+        self.rt_max = np.asarray(rt_max, dtype=np.float64)
+        self._interval_index = None
 
+    @classmethod
+    def from_dataframe(cls, centwave_df):
+        columns = {name: pd.to_numeric(centwave_df[col], errors='coerce').to_numpy(dtype=np.float64) for name, col in cls.centwave_columns.items()} # not always numeric when read from csv
+        return cls(centwave_df.index.to_numpy(), **columns)
 
+    @classmethod
+    def from_centwave_csv(cls, file_path):
+        return cls.from_dataframe(pd.read_csv(file_path, usecols=list(cls.centwave_columns.values())))
 
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return f"EICTable(EICs={len(self)})"
+
+    def interval_index(self):
+        if self._interval_index is None:
+            self._interval_index = EICIntervalIndex(self.rt_min, self.rt_max, self.mz_min, self.mz_max)
+        return self._interval_index
+
+    def find_eics(self, rts, mzs):
+        '''Row position of the first EIC containing each (rt, mz), -1 if none (see EICIntervalIndex.query).'''
+        return self.interval_index().query(rts, mzs)
+
+    def positions(self, eic_ids):
+        '''Row positions of the given EIC ids.'''
+        eic_ids = np.asarray(eic_ids, dtype=np.int64)
+        if np.all(self.ids[1:] > self.ids[:-1]): # ids are the csv row numbers, so normally already sorted
+            return np.searchsorted(self.ids, eic_ids)
+        order = np.argsort(self.ids, kind='stable')
+        return order[np.searchsorted(self.ids, eic_ids, sorter=order)]
@@ -0,0 +1,603 @@
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+import time
+
+from peak_picking import generate_scan_arrays_for_all_rt, mine_triples, mine_triples_streaming, load_raw_file
+from centwave import start_eic_detection
+from mass_decomposer import MassDecomposer, decompose_batch, format_decompositions
+from nominal_mass_pred import PredNomMass, k, MSE, corr_fact, diff_mass_sum
+from element_range_pred import ELEMENT_RR_MODELS, rr_model_rds_path, load_rr_model, load_rr_lookup_index, load_rr_grids, predict_element_ranges, validate_rr_grids
+from refined_hydrogen_rule import refined_hydrogen_rule_mask
+from Lipid_class_predictor import load_kmd_reference_index, find_kmd_matches_grouped
+from headgroup_checker import build_headgroup_table, check_heads
+from output_writer import AsyncOutputWriter
+from checkpoints import CheckpointStore, file_hash, stage_key
+
+# Only numpy/pandas backends are imported here, pyopenms (reading raw files) and rpy2 (R centWave) are imported
+# by the stages that use them, the first time they run.
+
+
+ATOM_MASSES_PATH = 'mass_decomp_background_files/res/atom-mono.masses'
+DECOMPOSITION_ELEMENTS = ['C', 'H', 'N', 'O', 'P'] # S not included for now
+RR_LOOKUP_TABLE_PATH = "database_folder/RR_lookup_table.csv"
+KMD_REFERENCE_PATH = 'database_folder/KMD_reference_database.csv'
+HEADGROUP_DATABASE_PATH = "database_folder/Headgroup_database.csv"
+
+# (stage, inputs, outputs) in order, the names are the keys of the run state
+PIPELINE_STAGES = [
+    ('mine_triples_and_eics', ('raw_file_path',), ('all_triples_dictionary', 'eic_table')),
+    ('filter_triples_by_eic', ('all_triples_dictionary', 'eic_table'), ('good_triple_dict', 'not_good_triples')),
+    ('predict_ranges', ('good_triple_dict', 'eic_table'), ('iso_pattern_df', 'iso_pattern_df_grouped')),
+    ('decompose', ('iso_pattern_df_grouped',), ('chemical_formulas_df', 'formula_table')),
+    ('apply_hydrogen_rule', ('chemical_formulas_df', 'formula_table'), ('chemical_formulas_df', 'formula_table_after_Hrule')),
+    ('match_subclasses', ('chemical_formulas_df', 'formula_table_after_Hrule'), ('lipidmaps_df',)),
+    ('check_headgroups', ('lipidmaps_df',), ('final_df',)),
+]
+
+# run state written as trackable outputs after each stage (LipsIpPipeline.track_stage_outputs)
+TRACKED_OUTPUTS = {
+    'mine_triples_and_eics': ('all_triples_dictionary',),
+    'filter_triples_by_eic': ('not_good_triples', 'good_triple_dict'),
+    'predict_ranges': ('iso_pattern_df', 'iso_pattern_df_grouped'),
+    'apply_hydrogen_rule': ('chemical_formulas_df', 'formula_table'),
+}
+
+
+def checkpoint_names(stage_position):
+    '''
+    What the checkpoint of a stage keeps: everything the later stages still use (the final table for the last one),
+    its trackable outputs (written again when a run resumes into another output folder) and the counts.
+    '''
+    stage = PIPELINE_STAGES[stage_position][0]
+    available = {name for stage_name, inputs, outputs in PIPELINE_STAGES[:stage_position + 1] for name in outputs}
+    later_inputs = [name for stage_name, inputs, outputs in PIPELINE_STAGES[stage_position + 1:] for name in inputs if name in available]
+    if stage_position == len(PIPELINE_STAGES) - 1:
+        later_inputs = list(PIPELINE_STAGES[-1][2])
+    return list(dict.fromkeys(later_inputs + list(TRACKED_OUTPUTS.get(stage, ())) + ['counts']))
+
+
+def load_shared_state(pred_interval=0.995, rr_grid_folder=None, rr_backend='R'):
+    '''
+    Models and databases every sample uses, loaded once and reused for all samples of a run
+    (the sample workers of batch_runner.py inherit them).
+
+    Return
+    ======
+        dict with the mass decomposer, the RR lookup index, the RR grids (or None), the KMD reference index and the headgroup table,
+        the RR models are kept in the element_range_pred cache (the R ones are read by each process on first use)
+    '''
+    if rr_backend == 'numpy':
+        for model_path in dict.fromkeys(ELEMENT_RR_MODELS.values()):
+            load_rr_model(model_path)
+    return {
+        'decomposer': MassDecomposer.from_masses_file(ATOM_MASSES_PATH, elements=DECOMPOSITION_ELEMENTS),
+        'RR_lookup_index': load_rr_lookup_index(RR_LOOKUP_TABLE_PATH),
+        'rr_grids': load_rr_grids(rr_grid_folder, pred_interval) if rr_grid_folder is not None else None,
+        'kmd_reference': load_kmd_reference_index(KMD_REFERENCE_PATH),
+        'headgroup_table': build_headgroup_table(pd.read_csv(HEADGROUP_DATABASE_PATH)),
+    }
+
+
+def grouped_range_columns(pred_interval):
+    '''
+    Names of the element range columns per EIC, {element}minpred_995_min and {element}maxpred_995_max for pred_interval 0.995.
+
+    Return
+    ======
+        ({element: min column}, {element: max column})
+    '''
+    interval_name = str(pred_interval).split('.')[-1]
+    return ({element: f'{element}minpred_{interval_name}_min' for element in ELEMENT_RR_MODELS},
+            {element: f'{element}maxpred_{interval_name}_max' for element in ELEMENT_RR_MODELS})
+
+
+def formulas_per_eic(entries, eic_index, n_eics):
+    '''Lists of the entries of every EIC (also empty ones), for the list columns of the outputs.'''
+    starts = np.searchsorted(eic_index, np.arange(n_eics + 1))
+    entries = list(entries)
+    return [entries[start:end] for start, end in zip(starts[:-1], starts[1:])]
+
+
+class LipsIpPipeline:
+    '''
+    The LIPS-IP steps as separate stages, each taking and returning the in-memory results of the previous one:
+
+        mine_triples_and_eics(raw_file_path)                      -> all_triples_dictionary, eic_table
+        filter_triples_by_eic(all_triples_dictionary, eic_table)  -> good_triple_dict, not_good_triples
+        predict_ranges(good_triple_dict, eic_table)               -> iso_pattern_df (per triple), iso_pattern_df_grouped (per EIC)
+        decompose(iso_pattern_df_grouped)                         -> chemical_formulas_df (per EIC), formula_table (per EIC and formula)
+        apply_hydrogen_rule(chemical_formulas_df, formula_table)  -> chemical_formulas_df, formula_table_after_Hrule
+        match_subclasses(chemical_formulas_df, formula_table_after_Hrule) -> lipidmaps_df
+        check_headgroups(lipidmaps_df)                            -> final_df
+
+    run(raw_file_path) does all of them for one sample and writes the trackable outputs to output_folder
+    (in the background, None to not write them), with checkpoint_folder it resumes from the stages already done (CheckpointStore).
+    shared_state: load_shared_state(), loaded on first use if not given.
+    decomposition_cache: optional DecompositionCache, r_eic_executor: optional executor kept for the R centWave of many samples.
+    '''
+    def __init__(self, shared_state=None, output_folder='trackable_outputs', pred_interval=0.995, charge=1, mass_error=5, n_workers=None,
+                 eic_detector='R', centwave_ppm=5, streaming=False, rr_backend='R', rr_grid_folder=None, rr_grid_method='linear', validate_rr_grids_against_exact=False,
+                 nitrogen_rule=False, kmd_tolerance=0.0075, checkpoint_folder=None, decomposition_cache=None, r_eic_executor=None):
+        self._shared_state = shared_state
+        self.output_folder = output_folder
+        self.pred_interval = pred_interval
+        self.charge = charge
+        self.mass_error = mass_error
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.eic_detector = eic_detector
+        self.centwave_ppm = centwave_ppm
+        self.streaming = streaming
+        self.rr_backend = rr_backend
+        self.rr_grid_folder = rr_grid_folder
+        self.rr_grid_method = rr_grid_method
+        self.validate_rr_grids_against_exact = validate_rr_grids_against_exact
+        self.nitrogen_rule = nitrogen_rule
+        self.kmd_tolerance = kmd_tolerance
+        self.checkpoint_folder = checkpoint_folder
+        self.decomposition_cache = decomposition_cache
+        self.r_eic_executor = r_eic_executor
+        self.output_writer = None
+
+        if not 0 < pred_interval < 1:
+            raise ValueError(f"pred_interval must be between 0 and 1, got {pred_interval}")
+        if eic_detector not in ('R', 'native'):
+            raise ValueError(f"eic_detector must be 'R' or 'native', got {eic_detector!r}")
+        if rr_backend not in ('R', 'numpy'):
+            raise ValueError(f"rr_backend must be 'R' or 'numpy', got {rr_backend!r}")
+        if rr_grid_folder is not None and rr_backend != 'numpy':
+            raise ValueError("The RR grids are built from the numpy RR models, use rr_backend = 'numpy' with rr_grid_folder")
+        if streaming and eic_detector == 'native':
+            raise ValueError("The native centWave needs all scans in memory, use eic_detector = 'R' with streaming")
+
+    @property
+    def shared_state(self):
+        if self._shared_state is None:
+            self._shared_state = load_shared_state(self.pred_interval, self.rr_grid_folder, self.rr_backend)
+        return self._shared_state
+
+    def track(self, output, file_name, **csv_kwargs):
+        '''Writes a trackable output (DataFrame to csv, anything else pickled) in the background, nothing is read back from them.'''
+        if self.output_folder is None:
+            return
+        if self.output_writer is None:
+            os.makedirs(self.output_folder, exist_ok=True)
+            self.output_writer = AsyncOutputWriter()
+        path = os.path.join(self.output_folder, file_name)
+        if isinstance(output, pd.DataFrame):
+            self.output_writer.to_csv(output, path, **csv_kwargs)
+        else:
+            self.output_writer.pickle(output, path)
+
+    def close(self):
+        '''Waits for the trackable outputs still being written.'''
+        if self.output_writer is not None:
+            self.output_writer.close()
+            self.output_writer = None
+
+    ################################
+    ##### STEP 1: Peak Picking #####
+    ################################
+
+    def mine_triples_and_eics(self, raw_file_path):
+        '''
+        Isotope triples of every scan, with the EICs detected by centWave in their own process at the same time.
+
+        Return
+        ======
+            all_triples_dictionary: {rt: [3x2 array [[m/z, intensity], ...], ...]}
+            eic_table: EICTable
+        '''
+        ### Centwave part to get EICs, in its own process while the triples are mined ####
+        temporary_folder = None
+        if self.output_folder is not None:
+            os.makedirs(self.output_folder, exist_ok=True)
+            centwave_output_file = os.path.join(self.output_folder, "centwave_output.csv")
+        else: # centWave still writes its peaks to a file, removed again after
+            temporary_folder = tempfile.TemporaryDirectory()
+            centwave_output_file = os.path.join(temporary_folder.name, "centwave_output.csv")
+        if self.eic_detector == 'R': # R centWave reads the raw file itself, it can start right away
+            print('Getting all EICs using centWave...')
+            eic_executor, eic_future = start_eic_detection('R', raw_file_path, centwave_output_file, ppm=self.centwave_ppm, executor=self.r_eic_executor)
+
+        if self.streaming:
+            all_triples_dictionary = mine_triples_streaming(raw_file_path, self.mass_error, n_workers=self.n_workers) # only the triples are kept
+        else:
+            exp = load_raw_file(raw_file_path)
+
+            ### Getting triples from raw data ###
+            scan_arrays = generate_scan_arrays_for_all_rt(exp) # columnar m/z and intensity arrays for all scans
+
+            if self.eic_detector == 'native': # native centWave works on the loaded scans
+                print('Getting all EICs using centWave...')
+                eic_executor, eic_future = start_eic_detection('native', raw_file_path, centwave_output_file, scan_arrays, ppm=self.centwave_ppm)
+
+            all_triples_dictionary = mine_triples(scan_arrays, self.mass_error, n_workers=self.n_workers) # keyed by RT, scans processed in parallel
+
+        print('There are', sum(len(items) for items in all_triples_dictionary.values()), 'triples before centwave.')
+
+        eic_table = eic_future.result() # join point: typed column arrays, (rt, mz) index built once on first lookup
+        if eic_executor is not self.r_eic_executor:
+            eic_executor.shutdown()
+        if temporary_folder is not None:
+            temporary_folder.cleanup()
+        print('Finished using Centwave.')
+        return all_triples_dictionary, eic_table
+
+    def filter_triples_by_eic(self, all_triples_dictionary, eic_table):
+        '''
+        Checking if mono isotopic mass of triple lies in a EIC from centWave (bad isotope patterns removed).
+
+        Return
+        ======
+            good_triple_dict: {rt: [(triple, EIC ID, EIC m/z, EIC rt min, EIC rt max, EIC rt), ...]}
+            not_good_triples: [(rt, monoisotopic m/z), ...]
+        '''
+        print('Checking if triples lie in a good quality EIC...')
+        triple_rts = np.array([rt for rt, triples in all_triples_dictionary.items() for triple in triples], dtype=np.float64)
+        triple_mzs = np.array([triple[0][0] for triples in all_triples_dictionary.values() for triple in triples], dtype=np.float64)
+        eic_positions = iter(eic_table.find_eics(triple_rts, triple_mzs)) # first matching EIC for every triple at once, -1 if none
+
+        not_good_triples = []
+        good_triple_dict = {}
+        for rt, triples in all_triples_dictionary.items():
+            good_triple_dict[rt] = []
+            for triple in triples:
+                eic_position = next(eic_positions)
+                if eic_position >= 0:
+                    good_triple_dict[rt].append((triple, eic_table.ids[eic_position], float(eic_table.mz[eic_position]), float(eic_table.rt_min[eic_position]),
+                                                 float(eic_table.rt_max[eic_position]), float(eic_table.rt[eic_position])))
+                else:
+                    not_good_triples.append((rt, triple[0][0]))
+
+        print('There are', sum(len(items) for items in good_triple_dict.values()), 'triples whose monoisotopic peak lies in a "good" peak range.')
+        return good_triple_dict, not_good_triples
+
+    ###########################################
+    #### STEP 2: Relative Ratio Prediction ####
+    ###########################################
+
+    def predict_ranges(self, good_triple_dict, eic_table):
+        '''
+        Isotope pattern features and C, H, N, O and P ranges of every good triple, then grouped by EIC.
+
+        Return
+        ======
+            iso_pattern_df: one row per triple with its features and {element}min/maxpred_{pred_interval}
+            iso_pattern_df_grouped: one row per EIC with the min of min and max of max of every element range,
+                                    wmean_mz, nom_mass, RT_min, RT_max and RT
+        '''
+        print('Predicting relative ratios and element ranges...')
+        charge = self.charge
+
+        # Extracting all necessary features from triples
+        triples_and_their_features = []
+        for rt, triples in good_triple_dict.items():
+            for triple in triples:
+                # isotope pattern features
+                mass1 = triple[0][0][0] + charge * 1.00727647  # FOR [M+H]+ or [M-H]-
+                mass2 = triple[0][1][0] + charge * 1.00727647
+                mass3 = triple[0][2][0] + charge * 1.00727647
+
+                wmean_mz = triple[2] + charge * 1.00727647
+
+                m21 = mass2 - mass1
+                m32 = mass3 - mass2
+                m31 = mass3 - mass1
+                abu1 = triple[0][0][1]
+                abu2 = triple[0][1][1]
+                abu3 = triple[0][2][1]
+
+                nom_mass = PredNomMass(mass1, k, MSE, corr_fact, diff_mass_sum)[0]
+                frac_mass = mass1 - nom_mass
+
+                triples_and_their_features.append({
+                    'RT': rt, 'mass1': mass1, 'mass2': mass2, 'mass3': mass3,
+                    'm21': m21, 'm32': m32, 'm31': m31, 'abu1': abu1, 'abu2': abu2,
+                    'abu3': abu3, 'nom_mass': nom_mass, 'frac_mass': frac_mass,
+                    'EIC_ID': triple[1], 'wmean_mz': wmean_mz, 'rt_min': triple[3],
+                    'rt_max': triple[4], 'rt': triple[5]
+                })
+
+        iso_pattern_df = pd.DataFrame(triples_and_their_features)
+        iso_pattern_df = iso_pattern_df.sort_values(by='mass1')
+        iso_pattern_df['m0'] = iso_pattern_df['mass1'] / 1000  # divide by 1000 as model fitted using this
+
+        RR_lookup_index = self.shared_state['RR_lookup_index'] # RR reference table, sorted by RR21 with min/max sparse tables
+
+        # RR models predicted with the R predRR.._agg functions, or with numpy from the coefficients exported by export_rr_models.py
+        # (rr_backend = 'numpy'), each model loaded and predicted once
+        print("Predicting C, H, N, O and P ranges...")
+        rr_grids = self.shared_state['rr_grids']
+        if rr_grids is not None and any(grid.pred_interval != self.pred_interval for grid in rr_grids.values()):
+            raise ValueError(f"The RR grids of shared_state are not for pred_interval {self.pred_interval}, load them with load_shared_state({self.pred_interval}, ...)")
+        element_ranges = predict_element_ranges(iso_pattern_df, RR_lookup_index, self.pred_interval, grids=rr_grids, grid_method=self.rr_grid_method,
+                                                rr_backend=self.rr_backend)
+        if rr_grids is not None and self.validate_rr_grids_against_exact:
+            rr_grid_report = validate_rr_grids(iso_pattern_df, RR_lookup_index, self.pred_interval, rr_grids, grid_method=self.rr_grid_method)
+            self.track(rr_grid_report, 'rr_grid_validation.csv', index=False)
+            print(rr_grid_report)
+        iso_pattern_df = pd.concat([iso_pattern_df.reset_index(drop=True), element_ranges], axis=1)
+
+
+        ## Prep for mass decomposition ##
+        iso_pattern_df['m0'] = iso_pattern_df['m0']*1000  # masses were /1000 for RR prediction
+
+        for col in iso_pattern_df.columns[-10:]:
+            iso_pattern_df[col] = iso_pattern_df[col].astype(int)  # whole element counts, kept numeric so the min/max per EIC below are numeric too
+
+        print('Element ranges predicted.')
+
+        # getting min of min and max of max for each element range for each EIC and using wmean calculated by centwWave for m/z from now on
+        lower_columns, upper_columns = grouped_range_columns(self.pred_interval)
+        range_aggregations = {}
+        for element in ELEMENT_RR_MODELS:
+            range_aggregations[lower_columns[element]] = (f'{element}minpred_{self.pred_interval}', 'min')
+            range_aggregations[upper_columns[element]] = (f'{element}maxpred_{self.pred_interval}', 'max')
+        iso_pattern_df_grouped = iso_pattern_df.groupby('EIC_ID').agg(
+                **range_aggregations,
+                nom_mass=('nom_mass', 'first'),
+            ).reset_index()
+
+        # EIC values are the same for all triples of an EIC so they are looked up in the EIC table
+        eic_rows = eic_table.positions(iso_pattern_df_grouped['EIC_ID'])
+        iso_pattern_df_grouped.insert(iso_pattern_df_grouped.columns.get_loc('nom_mass'), 'wmean_mz', eic_table.mz[eic_rows] + charge * 1.00727647)
+        iso_pattern_df_grouped['RT_min'] = eic_table.rt_min[eic_rows]
+        iso_pattern_df_grouped['RT_max'] = eic_table.rt_max[eic_rows]
+        iso_pattern_df_grouped['RT'] = eic_table.rt[eic_rows]
+
+        print("After grouping by EIC, there are", len(iso_pattern_df_grouped), "features.")
+        return iso_pattern_df, iso_pattern_df_grouped
+
+    ####################################
+    #### STEP 3: Mass Decomposition ####
+    ####################################
+
+    def decompose(self, iso_pattern_df_grouped):
+        '''
+        All formulas within mass_error of every EIC and its element ranges.
+
+        Return
+        ======
+            chemical_formulas_df: one row per EIC with Mass, RT, RTmin, RTmax, Number_of_decomps and Possible_formulas
+            formula_table: one row per (EIC, formula), 'EIC_index' (row in iso_pattern_df_grouped), the element counts,
+                           'formula', 'exact_mass', 'ppm_error' and 'entry' ('formula (mass)' as imsdecomp printed them)
+        '''
+        decomposer = self.shared_state['decomposer'] # lookup table built once
+
+        print('Mass Decompositions...')
+        # repeat masses/bounds (also from earlier runs and other samples) are not decomposed again
+        lower_columns, upper_columns = grouped_range_columns(self.pred_interval)
+        formula_table = decompose_batch(iso_pattern_df_grouped, decomposer, self.mass_error, error_unit='ppm', lower_columns=lower_columns,
+                                        upper_columns=upper_columns, n_workers=self.n_workers, cache=self.decomposition_cache) # one row per (EIC, formula)
+        if self.decomposition_cache is not None:
+            print(self.decomposition_cache)
+
+        # formula candidates are carried on as this flat table, the 'formula (mass)' strings are used as keys in the outputs
+        formula_table['entry'] = format_decompositions(formula_table)
+        eic_starts = np.searchsorted(formula_table['EIC_index'].to_numpy(), np.arange(len(iso_pattern_df_grouped) + 1))
+
+        mass_decomp_results = {
+            'Mass': iso_pattern_df_grouped['wmean_mz'].tolist(),
+            'RT': iso_pattern_df_grouped['RT'],
+            'RTmin': iso_pattern_df_grouped['RT_min'],
+            'RTmax': iso_pattern_df_grouped['RT_max'],
+            'Number_of_decomps': np.diff(eic_starts).tolist(),
+            'Possible_formulas': formulas_per_eic(formula_table['entry'], formula_table['EIC_index'].to_numpy(), len(iso_pattern_df_grouped))
+        }
+
+        chemical_formulas_df = pd.DataFrame(mass_decomp_results)
+
+        print('All possible chemical formulas found!')
+        return chemical_formulas_df, formula_table
+
+    ##########################################
+    #### STEP 4: Refined Hydrogen Rule ####
+    ##########################################
+
+    def apply_hydrogen_rule(self, chemical_formulas_df, formula_table):
+        '''
+        Refined hydrogen rule (and the nitrogen rule if nitrogen_rule) on all formulas at once.
+        Adds nominal_mass and Possible_formulas_after_Hrule to chemical_formulas_df and nominal_mass and passes_Hrule to formula_table.
+
+        Return
+        ======
+            chemical_formulas_df, formula_table_after_Hrule (the rows of formula_table passing the rule)
+        '''
+        chemical_formulas_df['nominal_mass'] = chemical_formulas_df['Mass'].apply(lambda mass: PredNomMass(mass, k, MSE, corr_fact, diff_mass_sum)[0]) #nominal mass predicted again because last time it was per RT spectrum
+
+        formula_table['nominal_mass'] = chemical_formulas_df['nominal_mass'].to_numpy()[formula_table['EIC_index'].to_numpy()]
+        formula_table['passes_Hrule'] = refined_hydrogen_rule_mask(formula_table, formula_table['nominal_mass'], nitrogen_rule=self.nitrogen_rule) # element count columns of the table, all EICs at once
+        formula_table_after_Hrule = formula_table[formula_table['passes_Hrule']].reset_index(drop=True)
+
+        chemical_formulas_df['Possible_formulas_after_Hrule'] = formulas_per_eic(formula_table_after_Hrule['entry'], formula_table_after_Hrule['EIC_index'].to_numpy(),
+                                                                                 len(chemical_formulas_df))
+
+        print('Refined hydrogen ule applied!')
+        return chemical_formulas_df, formula_table_after_Hrule
+
+    ###########################################
+    #### STEP 5: Subclass Prediction (KMD) ####
+    ###########################################
+
+    def match_subclasses(self, chemical_formulas_df, formula_table_after_Hrule):
+        '''
+        Subclasses with a matching KMD for every formula left after the hydrogen rule.
+
+        Return
+        ======
+            lipidmaps_df: chemical_formulas_df with 'Formula:subclass combos' ({formula entry: [(general abbreviation, n, sub class), ...]} per EIC)
+        '''
+        lipidmaps_df = chemical_formulas_df
+
+        reference_entries = self.shared_state['kmd_reference'] # sorted reference KMDs, built once
+
+        print('Finding possible subclasses...')
+        # exact masses straight from the formula table, no parsing of the formula strings
+        lipidmaps_df['Formula:subclass combos'] = find_kmd_matches_grouped(formula_table_after_Hrule['entry'].tolist(), formula_table_after_Hrule['exact_mass'].to_numpy(),
+                                                                           formula_table_after_Hrule['EIC_index'].to_numpy(), len(lipidmaps_df), reference_entries,
+                                                                           tolerance=self.kmd_tolerance)
+        return lipidmaps_df
+
+    ###################################
+    #### STEP 6: Headgroup Checker ####
+    ###################################
+
+    def check_headgroups(self, lipidmaps_df):
+        '''
+        Return
+        ======
+            final_df: lipidmaps_df with the key counts and the 'Unique Lipids List' whose headgroup and chains fit
+        '''
+        headgroup_table = self.shared_state['headgroup_table'] # one row per (class, additional O) with the chem formula as element counts, built once
+        return check_heads(lipidmaps_df, headgroup_table)
+
+    def stage_parameters(self):
+        '''
+        The parameters and input files each stage depends on (besides the output of the previous stage), used for the checkpoint keys.
+        n_workers and streaming are not in them, they do not change the results.
+        '''
+        return {
+            'mine_triples_and_eics': {'mass_error': self.mass_error, 'eic_detector': self.eic_detector, 'centwave_ppm': self.centwave_ppm},
+            'filter_triples_by_eic': {},
+            'predict_ranges': {'charge': self.charge, 'pred_interval': self.pred_interval,
+                               'rr_backend': self.rr_backend,
+                               'rr_models': {element: file_hash(model_path if self.rr_backend == 'numpy' else rr_model_rds_path(model_path))
+                                             for element, model_path in ELEMENT_RR_MODELS.items()},
+                               'rr_lookup_table': file_hash(RR_LOOKUP_TABLE_PATH),
+                               'rr_grids': self.rr_grid_parameters()},
+            'decompose': {'mass_error': self.mass_error, 'atom_masses': file_hash(ATOM_MASSES_PATH), 'elements': DECOMPOSITION_ELEMENTS},
+            'apply_hydrogen_rule': {'nitrogen_rule': self.nitrogen_rule},
+            'match_subclasses': {'kmd_tolerance': self.kmd_tolerance, 'kmd_reference': file_hash(KMD_REFERENCE_PATH)},
+            'check_headgroups': {'headgroup_database': file_hash(HEADGROUP_DATABASE_PATH)},
+        }
+
+    def rr_grid_parameters(self):
+        '''The RR grids predict_ranges actually uses (those in shared_state, not rr_grid_folder), None for exact predictions.'''
+        rr_grids = self.shared_state['rr_grids']
+        if rr_grids is None:
+            return None
+        return {'method': self.rr_grid_method,
+                'grids': {model_path: [grid.model_hash, grid.axes, grid.pred_interval, grid.S] for model_path, grid in rr_grids.items()}}
+
+    def stage_keys(self, raw_file_path):
+        '''Checkpoint key of every stage in PIPELINE_STAGES order, chained from the hash of the raw file.'''
+        stage_parameters = self.stage_parameters()
+        key = file_hash(raw_file_path)
+        keys = []
+        for stage, inputs, outputs in PIPELINE_STAGES:
+            key = stage_key(key, stage, stage_parameters[stage])
+            keys.append(key)
+        return keys
+
+    def count_stage_outputs(self, stage, state):
+        # counts for the summary
+        counts = state['counts']
+        if stage == 'mine_triples_and_eics':
+            counts['triples'] = sum(len(items) for items in state['all_triples_dictionary'].values())
+        elif stage == 'filter_triples_by_eic':
+            counts['good_triples'] = sum(len(items) for items in state['good_triple_dict'].values())
+        elif stage == 'predict_ranges':
+            counts['EICs'] = len(state['iso_pattern_df_grouped'])
+        elif stage == 'decompose':
+            counts['decompositions'] = len(state['formula_table'])
+        elif stage == 'apply_hydrogen_rule':
+            counts['formulas_after_Hrule'] = len(state['formula_table_after_Hrule'])
+
+    def track_stage_outputs(self, stage, state, sample_name):
+        '''Writes the trackable outputs of a stage (the TRACKED_OUTPUTS of state) to output_folder.'''
+        if self.output_folder is None:
+            return
+        if stage == 'mine_triples_and_eics':
+            # Saving a dictionary with all isotope patterns before centwave filtering
+            self.track(state['all_triples_dictionary'], f'all_triples_dictionary_{sample_name}.pkl')
+        elif stage == 'filter_triples_by_eic':
+            # Saving the 'bad' triples as list, these are not used anymore
+            self.track(state['not_good_triples'], f'not_good_triples_dictionary_{sample_name}.pkl')
+            # Saving the 'good' triples as dictionary, these are what we will continue with
+            self.track(state['good_triple_dict'], f'good_triples_dictionary_{sample_name}.pkl')
+            print('Good triples found and saved with corresponding EIC IDs.')
+        elif stage == 'predict_ranges':
+            # the features as they went into the RR prediction (m0 in kDa, no element ranges yet)
+            range_columns = [f'{element}{bound}pred_{self.pred_interval}' for element in ELEMENT_RR_MODELS for bound in ('min', 'max')]
+            features = state['iso_pattern_df'].drop(columns=range_columns).assign(m0=state['iso_pattern_df']['mass1'] / 1000)
+            self.track(features, 'good_triples_and_their_features.csv.zip', compression='zip', index=False)
+            self.track(state['iso_pattern_df'], 'element_range_predictions_per_individual_triple.csv.zip', compression='zip', index=False)
+            self.track(state['iso_pattern_df_grouped'], 'element_range_predictions_per_EIC.csv.zip', compression='zip',index=False) # ranges saved after triples gouped by EIC
+        elif stage == 'apply_hydrogen_rule':
+            self.track(state['chemical_formulas_df'], 'chemical_formulas_after_Hrule.csv', index=False)
+            self.track(state['formula_table'], 'formula_table.csv.zip', compression='zip', index=False)
+
+    def track_checkpointed_outputs(self, checkpoints, keys, first_stage, sample_name):
+        # a resumed run writes the trackable outputs of the skipped stages again from their checkpoints,
+        # e.g. a batch rerun into a new output folder
+        if self.output_folder is None:
+            return
+        for i in range(first_stage):
+            stage = PIPELINE_STAGES[i][0]
+            if stage not in TRACKED_OUTPUTS:
+                continue
+            if not checkpoints.exists(stage, keys[i]):
+                print('No checkpoint of', stage, 'left, its trackable outputs are not written again.')
+                continue
+            self.track_stage_outputs(stage, checkpoints.load(stage, keys[i]), sample_name)
+
+    def run(self, raw_file_path, final_output_path=None):
+        '''
+        All stages for one raw file, the final table is saved to final_output_path ({raw_file_path}_output.csv by default).
+        With a checkpoint_folder, the output of every stage is saved under its key (stage_keys) and a rerun starts
+        after the last stage whose checkpoint exists, e.g. only Steps 5 and 6 run again when only kmd_tolerance changed.
+        The trackable outputs of the skipped stages are written again from their checkpoints (centwave_output.csv is not,
+        it is written by centWave itself).
+
+        Return
+        ======
+            (final_df, summary dict with the counts of every step)
+        '''
+        start_time = time.time()
+        sample_name = os.path.basename(raw_file_path)
+        state = {'raw_file_path': raw_file_path, 'counts': {}}
+
+        checkpoints = None
+        first_stage = 0
+        if self.checkpoint_folder is not None:
+            checkpoints = CheckpointStore(self.checkpoint_folder)
+            keys = self.stage_keys(raw_file_path)
+            for i in reversed(range(len(PIPELINE_STAGES))):
+                if checkpoints.exists(PIPELINE_STAGES[i][0], keys[i]):
+                    state.update(checkpoints.load(PIPELINE_STAGES[i][0], keys[i]))
+                    first_stage = i + 1
+                    print('Resuming after', PIPELINE_STAGES[i][0], 'from its checkpoint.')
+                    break
+
+        try:
+            if first_stage:
+                self.track_checkpointed_outputs(checkpoints, keys, first_stage, sample_name)
+            for i in range(first_stage, len(PIPELINE_STAGES)):
+                stage, inputs, outputs = PIPELINE_STAGES[i]
+                result = getattr(self, stage)(*[state[name] for name in inputs])
+                state.update(zip(outputs, result if len(outputs) > 1 else (result,)))
+                self.count_stage_outputs(stage, state)
+                self.track_stage_outputs(stage, state, sample_name)
+                if checkpoints is not None: # saved right away, the later stages add columns to some of these tables
+                    checkpoints.save(stage, keys[i], {name: state[name] for name in checkpoint_names(i)})
+
+            final_df = state['final_df']
+            if final_output_path is None:
+                final_output_path = f'{raw_file_path}_output.csv'
+            #final_df.to_csv(f'{raw_file_path}_output.csv.zip', compression='zip', index=False)
+            final_df.to_csv(final_output_path, index=False)
+        finally:
+            self.close() # waits for the trackable outputs still being written
+
+        summary = dict({'sample': sample_name}, **state['counts'])
+        summary.update({
+            'EICs_with_lipids': int((final_df['Unique Lipids Count'] > 0).sum()),
+            'unique_lipids': len({lipid for lipids in final_df['Unique Lipids List'] if lipids for lipid in lipids}),
+            'resumed_after': PIPELINE_STAGES[first_stage - 1][0] if first_stage else None,
+            'seconds': time.time() - start_time,
+            'output': final_output_path,
+        })
+        print('Done with', sample_name, 'in', summary['seconds'], 'seconds')
+        return final_df, summary
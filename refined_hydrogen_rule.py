@@ -1,3 +1,8 @@
+import re
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
 from nominal_mass_pred import *
 
 # Function to extract element count from the formula
@@ -14,25 +19,62 @@ def extract_element_count(formula, element):
     return int(formula[number_start:number_end] or 0)
 
 
-def apply_rules(row, formula_column):
-    nominal_mass = row['nominal_mass']
-    formulas = row[formula_column]
-    valid_formulas = []
-
-    for formula in formulas:
-        h_count = extract_element_count(formula, 'H')
-        br_count = extract_element_count(formula, 'Br')
-        cl_count = extract_element_count(formula, 'Cl')
-        n_count = extract_element_count(formula, 'N')
-        p_count = extract_element_count(formula, 'P')
-
-        '''# Check the first nitrogen rule
-        if (nominal_mass % 2 == 0 and n_count % 2 != 0) or (nominal_mass % 2 != 0 and n_count % 2 == 0):
-            continue  # Skip this formula if it doesn't satisfy the nitrogen rule'''
-        
-        result = (31 * p_count + h_count + 35 * cl_count + 79 * br_count) % 4 + nominal_mass % 4
-        
-        if result % 4 == 0:
-            valid_formulas.append(formula)
-    
-    return valid_formulas
+HRULE_ELEMENTS = ('C', 'H', 'N', 'O', 'P', 'S', 'Cl', 'Br')
+_element_pattern = re.compile(r'([A-Z][a-z]?)(\d*)')
+
+
+def element_count_matrix(formulas, elements=HRULE_ELEMENTS):
+    '''
+    Parses formulas ('C41H81N1O8P1' or 'C41H81N1O8P1 (760.585123)') once into an integer matrix, one column per element.
+    Element symbols are matched whole, so 'Cl' is not counted as 'C' and a missing count means 1.
+
+    Return
+    ======
+        np.ndarray of shape (len(formulas), len(elements))
+    '''
+    columns = {element: i for i, element in enumerate(elements)}
+    counts = np.zeros((len(formulas), len(elements)), dtype=np.int64)
+    for row, formula in enumerate(formulas):
+        for element, count in _element_pattern.findall(formula.split(' ', 1)[0]):
+            if element in columns:
+                counts[row, columns[element]] += int(count or 1)
+    return counts
+
+
+def refined_hydrogen_rule_mask(element_counts, nominal_mass, nitrogen_rule=False):
+    '''
+    The refined hydrogen rule (31P + H + 35Cl + 79Br) % 4 + nominal mass % 4 == 0 (mod 4) for all candidates at once.
+    element_counts: DataFrame (or dict of arrays) with one column of counts per element, elements not in it count as 0,
+                    or the (n, len(HRULE_ELEMENTS)) matrix of element_count_matrix with its default elements.
+    nominal_mass: nominal mass of every candidate (or one for all of them).
+    nitrogen_rule: also require the parity of N to match the parity of the nominal mass.
+
+    Return
+    ======
+        boolean np.ndarray, True for the candidates kept
+    '''
+    if isinstance(element_counts, np.ndarray):
+        if element_counts.ndim != 2 or element_counts.shape[1] != len(HRULE_ELEMENTS):
+            raise ValueError(f"element count matrix must have one column per element of HRULE_ELEMENTS {HRULE_ELEMENTS}, got shape {element_counts.shape}")
+        element_counts = dict(zip(HRULE_ELEMENTS, element_counts.T))
+    elif not isinstance(element_counts, (pd.DataFrame, Mapping)):
+        raise TypeError(f"element_counts must be a DataFrame, a dict of arrays or an element count matrix, not {type(element_counts).__name__}")
+
+    def count(element):
+        return np.asarray(element_counts[element], dtype=np.int64) if element in element_counts else 0
+
+    nominal_mass = np.asarray(nominal_mass)
+    result = (31 * count('P') + count('H') + 35 * count('Cl') + 79 * count('Br')) % 4 + nominal_mass % 4
+    mask = result % 4 == 0
+
+    if nitrogen_rule:
+        mask &= count('N') % 2 == nominal_mass % 2
+
+    return mask
+
+
+def apply_rules(row, formula_column, nitrogen_rule=False):
+    formulas = list(row[formula_column])
+    counts = element_count_matrix(formulas)
+    mask = refined_hydrogen_rule_mask(counts, row['nominal_mass'], nitrogen_rule=nitrogen_rule)
+    return [formula for formula, keep in zip(formulas, mask) if keep]